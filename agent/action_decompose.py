@@ -1,45 +1,69 @@
 import os
-import boto3
-import json
+import re
 import sys
+import orjson
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterator, Tuple
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from tools.cache_utils import get_cache  # 要用跟 Chatbot 一樣的 cache
+from tools.cache_utils import get_cache, get_intent_cache  # 要用跟 Chatbot 一樣的 cache
+from cache_tools.cache import normalize_query
+from tools.client_utils import get_bedrock_runtime_client
+from tools.retry_utils import retry_transient
+from task_classification.task_classification import TASK_CLASSIFICATION_PROMPT
+from tools.bedrock_utils import (
+    build_cached_system,
+    build_converse_system,
+    converse_text,
+    iter_converse_stream_text,
+    iter_invoke_stream_text,
+    iter_invoke_stream_tool_json,
+    supports_latency_optimized,
+)
 from botocore.exceptions import ClientError
 
-class ActionDecomposer:
-    def __init__(self, model_id=None):
-        self.client = boto3.client("bedrock-runtime")
-        self.model_id = model_id or "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
-        self.cache = get_cache()
+logger = logging.getLogger(__name__)
+
+# 分類 + 拆解一次完成時，用 tool use 強制模型照 schema 回覆
+ROUTE_TASK_TOOL = {
+    "name": "route_task",
+    "description": "回報任務類型；若為「行動」，一併回報動作拆解結果。",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "type": {"type": "string", "enum": ["查詢", "聊天", "行動", "其他"]},
+            "steps": {"type": "string", "description": "任務類型為「行動」時的動作拆解結果，其餘類型留空"},
+        },
+        "required": ["type"],
+    },
+}
 
-        self.system_prompt = """
-你是一個機器人動作拆解助理，使用者會傳來一段「動作任務」文字，你的工作是：
-
-【總則要求】
-1. 僅能使用「可執行清單」中定義的動作。
-2. 每一個任務描述中的實際動作，都必須明確且完整對應到可執行清單中的動作。
-3. 若任務中包含任何不可支援的行為（例如：訂便當、開車、打電話、上網、操作電腦等），或無法完整以清單內動作表達時，只輸出：「目前不支援此行動命令」，**禁止提供任何說明、解釋、推論或補充資訊。**僅輸出該句，嚴禁添加其他文字。。
-
-【格式要求】
-- 成功拆解時，請依照步驟列出「編號 → 編號 → 編號 → …」。
-- 並逐步列出每個編號對應的簡短文字說明（每行一個步驟）。
-- 步驟說明務必簡單清楚，不可添加多餘說明或推測。
-- 動作無法執行時，不要額外解釋原因。
-
-【步驟說明】
-- 步驟說明中不要使用 A物體、A液體等字眼，直接改為代表物體。
-- 到液體前應要在拿起該容器的狀態，結束才要放下該容器。
-- 倒液體的動作要有相應的停下動作。
-- 按下或放開按鈕僅代表該物理動作，不應預設其用途（例如開機、關機等），用途請由任務語意推斷。
-- 說話的步驟，請使用中文引號「」標註說話內容。
-- 動作無法執行時，不要額外解釋原因。
-
-【重要提醒】
-- **不得用「說話」來代替無法執行的真實動作。**
-- **只要有任何一個任務要求無法用清單動作完成，即使其他部分可以完成，也要整個任務判定為「目前不支援此行動命令」。**
-- **禁止想像、補充、推測使用者的意圖。僅依描述內容判斷。**
-- **動作無法執行時，不要額外解釋原因。**
+FUSED_HEADER = """
+你要同時完成兩件事，並且只能透過呼叫 route_task 工具回覆（忽略下方要求的 <class>/<extra> 標籤格式）：
+一、依照【任務分類】判斷任務類型，填入 type。
+二、若類型為「行動」，依照【動作拆解】的規則輸出拆解結果，填入 steps；其他類型 steps 留空。
+
+【任務分類】
+"""
+
+# 規則與範例分開維護，送出時接成同一個 cache 區塊（見 SYSTEM_PROMPT）
+RULES_PROMPT = """
+你是機器人動作拆解助理，使用者會傳來一段「動作任務」文字，請只用【可執行清單】中的動作把它完整拆解出來。
+
+【規則】
+1. 每個實際動作都必須明確對應到清單中的動作；不得用「說話」代替無法執行的真實動作。
+2. 只要有任何一部分無法用清單動作完成（例如：訂便當、開車、打電話、上網、操作電腦等），整個任務只輸出「目前不支援此行動命令」，不得有任何說明、推論或其他文字。
+3. 不要想像、補充或推測使用者意圖，只依描述內容判斷。
+
+【格式】
+- 第一行列出動作編號「編號 → 編號 → …」，之後每行一個步驟的簡短說明，不加多餘文字。
+- 說明中直接寫出物體名稱，不要用 A物體、A液體等字眼。
+- 倒液體前要先拿起容器，結束後才放下，且倒液體要有對應的停止動作。
+- 按下或放開按鈕只代表該物理動作，用途由任務語意推斷。
+- 說話內容用中文引號「」標註。
 
 【可執行清單】
 1. 從 A 走到 B
@@ -50,24 +74,24 @@ class ActionDecomposer:
 6. 按下 A 按鈕
 7. 放開 A 按鈕
 8. 說話，說話內容為 A
+"""
 
-【範例輸入與輸出】
-
-範例輸入(1):
-幫我送這張請購單去給工讀生
-
-範例輸出(1):
+EXAMPLES_PROMPT = """
+<examples>
+<example>
+<input>幫我送這張請購單去給工讀生</input>
+<output>
 1 → 2 → 1 → 3 → 8
 從原點走到使用者位置
 拿起請購單
 從使用者位置走到工讀生位置
 放下請購單
 說話，通知工讀生
-
-範例輸入(2):
-幫我拿這個杯子去茶水間倒杯溫開水回來
-
-範例輸出(2):
+</output>
+</example>
+<example>
+<input>幫我拿這個杯子去茶水間倒杯溫開水回來</input>
+<output>
 1 → 2 → 1 → 3 → 6 → 7 → 2 → 1 → 3 → 8
 從原點走到使用者位置
 拿起水杯
@@ -79,58 +103,332 @@ class ActionDecomposer:
 從飲水機位置走到使用者位置
 放下水杯
 說話，通知使用者
-
-範例輸入(3):
-幫我開公務車去台大機械系載設備回來
-
-範例輸出(3):
-目前不支援此行動命令
-
-範例輸入(4):
-幫我開啟辦公室中的電腦
-範例輸出(4):
+</output>
+</example>
+<example>
+<input>幫我開啟辦公室中的電腦</input>
+<output>
 1 → 6 → 7 → 8
 走到電腦位置
 按下開機按鈕
 放開開機按鈕
 說話，通知使用者
+</output>
+</example>
+<example>
+<input>幫我開公務車去台大機械系載設備回來</input>
+<output>目前不支援此行動命令</output>
+</example>
+</examples>
+"""
 
-範例輸入(5):
-幫我定便當給我的朋友
+# Bedrock 的 prompt cache 是照前綴比對的，拆成兩個檢查點也不會讓範例在規則改動後繼續命中；
+# 而且單獨的規則或範例都不到最小可快取長度（Sonnet 1024 / 3.5 Haiku 2048 tokens），那個檢查點根本不會生效。
+# 所以只在整段 system prompt 結尾放一個檢查點。合併分類的 prompt 遠超過門檻；單獨拆解的這段大約落在 Sonnet 門檻附近，
+# 不到門檻時 cache_control 只是不生效，不會出錯
+SYSTEM_PROMPT = RULES_PROMPT + EXAMPLES_PROMPT
 
-範例輸出(5):
-目前不支援此行動命令
+UNSUPPORTED_RESPONSE = "目前不支援此行動命令"
 
-"""
+# 明顯不在可執行清單內的行為：命中且沒有任何清單動作時，不必問模型就能直接拒絕
+UNSUPPORTED_PATTERN = re.compile(
+    "開車|開公務車|[訂定]便當|叫外送|打電話|上網|操作電腦|[傳發]訊息|"
+    "[訂買].{0,2}票|訂飯店|付款|轉帳"
+)
+SUPPORTED_VERB_PATTERN = re.compile("走到|拿|放|倒|按|說")
+
+# 只要求說一句話（內容用「」標出）時，直接套用動作 8
+SAY_ONLY_PATTERN = re.compile("^(?:請|幫我)?(?:說|講)「([^「」]+)」$")
+
+def shortcut_response(task_text: str):
+    """不需要模型就能判斷的任務直接回傳結果，否則回傳 None"""
+    text = task_text.strip().rstrip("。！!")
+    say = SAY_ONLY_PATTERN.match(text)
+    if say:
+        return f"8\n說話，「{say.group(1)}」"
+    if UNSUPPORTED_PATTERN.search(text) and not SUPPORTED_VERB_PATTERN.search(text):
+        return UNSUPPORTED_RESPONSE
+    return None
+
+# 拆解結果最多十幾行，256 tokens 很夠；模型若開始自己接下一題就停下來
+MAX_TOKENS = 256
+STOP_SEQUENCES = ["任務描述：", "</output>"]
+
+# 明確到不需要問模型的分類：只收很短、句型固定的句子，其餘一律交給模型判斷
+# 設 INTENT_FAST_PATH=0 可以整個關掉，全部回到模型分類
+INTENT_FAST_PATH = os.getenv("INTENT_FAST_PATH", "1") != "0"
+CHAT_PATTERN = re.compile("^(?:嗨|哈囉|你好|您好|早安|午安|晚安|謝謝|謝啦|掰掰|再見)(?:啊|呀|喔|唷|你好嗎)?$")
+IMPERATIVE_PATTERN = re.compile("^(?:請|幫我|麻煩)")
+QUESTION_PATTERN = re.compile("嗎|？|\\?|多久|怎麼|如何|多少|哪")
+QUERY_PATTERN = re.compile("^(?!.*(?:我|你覺得))(?:請問)?(?:今天|明天|現在)?.{0,4}(?:天氣|新聞|股價|匯率).{0,6}(?:如何|怎麼樣|怎樣|多少|是什麼|嗎|呢)$")
+
+def is_command(task_text: str) -> bool:
+    """「幫我 / 請 …」開頭又不是問句，才算確定是要機器人去做的事"""
+    text = task_text.strip()
+    return bool(IMPERATIVE_PATTERN.match(text)) and not QUESTION_PATTERN.search(text)
+
+def fast_classify(task_text: str):
+    """句型固定的句子直接在本機分類，回傳 (任務類型, 拆解結果)；判斷不了回傳 None"""
+    if not INTENT_FAST_PATH:
+        return None
+    # 「說「…」」一定是行動；不支援的動詞只有在明確是命令句時才直接拒絕，
+    # 不然「開車去台南要多久？」「今天上網好慢」這類查詢 / 聊天也會被當成行動擋掉
+    shortcut = shortcut_response(task_text)
+    if shortcut and (shortcut != UNSUPPORTED_RESPONSE or is_command(task_text)):
+        return "行動", shortcut
+    text = task_text.strip().rstrip("。！!？?～~")
+    if CHAT_PATTERN.match(text):
+        return "聊天", ""
+    if QUERY_PATTERN.match(text):
+        return "查詢", ""
+    return None
+
+# 語意快取跟 Chatbot 共用，裡面也有聊天回覆；第一行是「編號 → 編號」的才當成拆解結果
+STEPS_PATTERN = re.compile(r"^\d+(?:\s*→\s*\d+)*\n")
+
+# route_task 參數串流時，type 欄位一出現就能判斷類型
+_TOOL_TYPE_PATTERN = re.compile(r'"type"\s*:\s*"([^"]+)"')
+
+# 任務文字在預先序列化好的 body 裡的佔位字串
+_TASK_PLACEHOLDER = "__TASK__"
+_TASK_SLOT = f'"{_TASK_PLACEHOLDER}"'.encode("utf-8")
+
+@lru_cache(maxsize=None)
+def _body_template(model_id: str) -> bytes:
+    """除了任務文字以外整個 body 都是固定的，每個 model 只序列化一次（orjson 直接輸出 UTF-8，中文不會被跳脫）"""
+    body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": MAX_TOKENS,
+        "temperature": 0.0,
+        "top_k": 1,
+        "stop_sequences": STOP_SEQUENCES,
+        "system": build_cached_system([SYSTEM_PROMPT], model_id),
+        "messages": [
+            {
+                "role": "user",
+                "content": _TASK_PLACEHOLDER
+            }
+        ]
+    }
+    return orjson.dumps(body)
+
+@lru_cache(maxsize=None)
+def _fused_body_template(model_id: str) -> bytes:
+    """classify_and_decompose 的 body：system prompt 和 tool schema 都是固定的，一樣只序列化一次"""
+    body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 512,
+        "temperature": 0.0,
+        "system": build_cached_system(
+            [FUSED_HEADER + TASK_CLASSIFICATION_PROMPT + "\n【動作拆解】\n" + SYSTEM_PROMPT],
+            model_id,
+        ),
+        "tools": [ROUTE_TASK_TOOL],
+        "tool_choice": {"type": "tool", "name": ROUTE_TASK_TOOL["name"]},
+        "messages": [{"role": "user", "content": _TASK_PLACEHOLDER}],
+    }
+    return orjson.dumps(body)
+
+def _splice_task(template: bytes, task_text: str) -> bytes:
+    # 只把任務文字塞進預先序列化好的 body，不用每次重建 dict 再 dumps 整段 system prompt
+    task_json = orjson.dumps(f"任務描述：{task_text}")
+    return template.replace(_TASK_SLOT, task_json, 1)
+
+# 寫回語意快取要算一次 Titan embedding（有 Redis 還要 hset），丟到背景做，不擋住回覆；單一 worker 照順序寫
+_cache_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-write")
+
+class ActionDecomposer:
+    def __init__(self, model_id=None):
+        self.client = get_bedrock_runtime_client()
+        self.model_id = model_id or "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
+        self.cache = get_cache()
+        self.intent_cache = get_intent_cache()
+        # 正在問模型的句子：同一句話同時進來（多個分頁、重複送出）就等同一個結果，不重複呼叫
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # 規則與範例是模組層級常數，所有 instance 共用同一份字串
+        self.rules_prompt = RULES_PROMPT
+        self.examples_prompt = EXAMPLES_PROMPT
+        self.system_prompt = SYSTEM_PROMPT
+
+    def warm_up(self):
+        """送一個 1 token 的請求，把 bedrock-runtime 的 TLS 連線先建好放進連線池"""
+        try:
+            self.client.invoke_model(
+                modelId=self.model_id,
+                contentType="application/json",
+                accept="application/json",
+                body=orjson.dumps({
+                    "anthropic_version": "bedrock-2023-05-31",
+                    "max_tokens": 1,
+                    "messages": [{"role": "user", "content": "hi"}],
+                })
+            )
+        except Exception as e:
+            print(f"Bedrock warm up failed: {e}")
 
+    def _converse_kwargs(self, task_text: str) -> dict:
+        return {
+            "modelId": self.model_id,
+            "system": build_converse_system([self.system_prompt], self.model_id),
+            "messages": [{"role": "user", "content": [{"text": f"任務描述：{task_text}"}]}],
+            "inferenceConfig": {"maxTokens": MAX_TOKENS, "temperature": 0.0, "stopSequences": STOP_SEQUENCES},
+            "additionalModelRequestFields": {"top_k": 1},
+            "performanceConfig": {"latency": "optimized"},
+        }
+
+    def _build_body(self, task_text: str) -> bytes:
+        return _splice_task(_body_template(self.model_id), task_text)
+
+    def _converse_optimized(self, task_text: str) -> str:
+        """走 Converse API 的 latency-optimized 端點"""
+        response = self.client.converse(**self._converse_kwargs(task_text))
+        return converse_text(response)
+
+    @retry_transient()
     def _generate_response(self, task_text: str) -> str:
         """真正丟 Bedrock 的方法，內部用"""
-        body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 512,
-            "temperature": 0.0,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": f"{self.system_prompt}\n\n任務描述：{task_text}"
-                }
-            ]
-        }
+        if supports_latency_optimized(self.model_id):
+            return self._converse_optimized(task_text)
 
         response = self.client.invoke_model(
             modelId=self.model_id,
             contentType="application/json",
             accept="application/json",
-            body=json.dumps(body)
+            body=self._build_body(task_text)
         )
 
-        result = response["body"].read().decode("utf-8")
-        payload = json.loads(result)
+        # orjson 直接吃 bytes，省掉一次 decode
+        payload = orjson.loads(response["body"].read())
         content_blocks = payload.get("content", [])
         return "\n".join(block.get("text", "") for block in content_blocks).strip()
 
+    @retry_transient()
+    def _open_stream(self, task_text: str):
+        """建立串流，回傳 (底層事件串流, 文字 iterator)；開始吐字之後就沒辦法重來，只重試這一步"""
+        if supports_latency_optimized(self.model_id):
+            response = self.client.converse_stream(**self._converse_kwargs(task_text))
+            return response["stream"], iter_converse_stream_text(response)
+
+        response = self.client.invoke_model_with_response_stream(
+            modelId=self.model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=self._build_body(task_text)
+        )
+        return response["body"], iter_invoke_stream_text(response)
+
+    def _generate_stream(self, task_text: str) -> Iterator[str]:
+        """串流版本：模型每吐出一段文字就 yield 出去"""
+        events, texts = self._open_stream(task_text)
+
+        # 呼叫端提早結束（例如已經確定是拒絕）時，把底下的 HTTP 串流一起關掉
+        try:
+            yield from texts
+        finally:
+            events.close()
+
+    def classify_and_decompose(self, task_text: str) -> Tuple[str, str]:
+        """分類與拆解合成一次呼叫，回傳 (任務類型, 拆解結果)；本機規則或分類快取命中就不呼叫模型"""
+        fast = fast_classify(task_text)
+        if fast:
+            return fast
+
+        cached = self.intent_cache.get(task_text)
+        if cached:
+            # 每句話都可能走到這裡，用 % 參數，沒開 DEBUG 時不必組字串
+            logger.debug("intent cache hit: %s -> %s %s", task_text, cached[0], self.intent_cache.stats())
+            return cached
+
+        key = normalize_query(task_text)
+        # 只剩標點、emoji 的句子正規化後是空字串，彼此不相同，不能共用同一個結果（跟 IntentCache 一樣不處理）
+        if not key:
+            return self._classify_uncached(task_text)
+
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = self._classify_uncached(task_text)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    def _classify_uncached(self, task_text: str) -> Tuple[str, str]:
+        # 本機規則跟分類快取都沒中，才查語意快取（要算一次 embedding）；語意相近的行動命令之前拆過就直接用
+        steps = self._query_semantic_cache(task_text)
+        if steps and (steps == UNSUPPORTED_RESPONSE or STEPS_PATTERN.match(steps)):
+            task_type = "行動"
+            self.cache.session_log.append((task_text, steps))
+        else:
+            task_type, steps = self._classify_and_decompose(task_text)
+        self.intent_cache.put(task_text, task_type, steps)
+        return task_type, steps
+
+    def _query_semantic_cache(self, task_text: str):
+        try:
+            return self.cache.query_cache(task_text)
+        except ClientError as e:
+            # 查不到快取就照常問模型，不讓 embedding 的錯誤擋住這一輪
+            print(f"semantic cache lookup failed: {e}")
+            return None
+
+    def _write_semantic_cache(self, task_text: str, steps: str):
+        try:
+            self.cache.add_to_cache(task_text, steps)
+        except Exception as e:
+            print(f"semantic cache write failed: {e}")
+
+    @retry_transient()
+    def _classify_and_decompose(self, task_text: str) -> Tuple[str, str]:
+        # 有支援的模型（3.5 Haiku）改走 latency-optimized 推論，其餘維持標準端點
+        latency = {"performanceConfigLatency": "optimized"} if supports_latency_optimized(self.model_id) else {}
+        response = self.client.invoke_model_with_response_stream(
+            modelId=self.model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=_splice_task(_fused_body_template(self.model_id), task_text),
+            **latency
+        )
+
+        # 查詢 / 聊天 / 其他用不到 steps，type 一串出來就關掉串流，不等模型把整個 tool_use 收尾
+        parts = []
+        try:
+            for partial in iter_invoke_stream_tool_json(response):
+                parts.append(partial)
+                matched = _TOOL_TYPE_PATTERN.search("".join(parts))
+                if matched and matched.group(1) != "行動":
+                    return matched.group(1), ""
+        finally:
+            response["body"].close()
+
+        if not parts:
+            return "", ""
+        tool_input = orjson.loads("".join(parts))
+        task_type = tool_input.get("type", "")
+        steps = tool_input.get("steps", "").strip()
+        if task_type == "行動" and steps:
+            _cache_writer.submit(self._write_semantic_cache, task_text, steps)
+            self.cache.session_log.append((task_text, steps))
+        return task_type, steps
+
     def decompose(self, task_text: str) -> str:
         """先查 cache，沒中才丟模型"""
+        shortcut = shortcut_response(task_text)
+        if shortcut:
+            return shortcut
+
         try:
             response = self.cache.get_or_generate_response(
                 task_text, self._generate_response
@@ -140,6 +438,37 @@ class ActionDecomposer:
             print(f"API ERROR: {e}")
             return "目前伺服器有問題，請稍後再試。"
 
+    def decompose_stream(self, task_text: str) -> Iterator[str]:
+        """串流版 decompose：cache 命中就一次回傳，沒中就邊生成邊 yield，結束後再寫回 cache"""
+        shortcut = shortcut_response(task_text)
+        if shortcut:
+            yield shortcut
+            return
+
+        try:
+            cached = self.cache.query_cache(task_text)
+            if cached:
+                self.cache.session_log.append((task_text, cached))
+                yield cached
+                return
+
+            pieces = []
+            stream = self._generate_stream(task_text)
+            for delta in stream:
+                pieces.append(delta)
+                yield delta
+                # 拒絕句只有十來個 token，湊滿就不必等模型自己收尾
+                if "".join(pieces).strip() == UNSUPPORTED_RESPONSE:
+                    stream.close()
+                    break
+
+            response = "".join(pieces).strip()
+            self.cache.add_to_cache(task_text, response)
+            self.cache.session_log.append((task_text, response))
+        except ClientError as e:
+            print(f"API ERROR: {e}")
+            yield "目前伺服器有問題，請稍後再試。"
+
 if __name__ == "__main__":
     decomposer = ActionDecomposer()
     task = "請你記得等一下要幫我關燈。"
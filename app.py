@@ -1,28 +1,18 @@
 import os
-import threading
-import asyncio
-import time
 import logging
-from pathlib import Path
-from flask import Flask, render_template_string, send_from_directory
+from flask import Flask
 from flask_socketio import SocketIO
-from tools.retry_utils import retry_async, retry_sync
-from live_transcriber.live_transcriber import LiveTranscriber
-from rag_chat.rag import RAGPipeline, WebSearcher, ConversationalModel
-from rag_chat.chat import Chatbot
-from tts.tts import PollyTTS
-from agent.action_decompose import ActionDecomposer
-from task_classification.task_classification import TaskClassifier
+from core.web import HISTORY_DIR, NoDelayRequestHandler, make_index, orjson_socketio, send_history_audio
+from core.pipeline import cancellable_run_pipeline, get_loop, submit, warm_up_services
+from core.live import start_transcriber
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__, static_folder="static")
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# --- 🔥 可取消的處理任務狀態
-current_task = None
-current_task_lock = threading.Lock()
+# 刻意用 threading：真正的工作都在 core 的 asyncio loop / process pool 上跑，handler 只負責丟任務、馬上返回；
+# eventlet / gevent 的 monkey-patch 會跟 asyncio thread、multiprocessing、boto3 連線池互相干擾
+socketio = SocketIO(app, async_mode="threading", cors_allowed_origins="*", json=orjson_socketio)
 
 HTML = '''
 <!doctype html>
@@ -97,9 +87,6 @@ HTML = '''
       color: #0b0c10;
       margin-top: 12px;
     }
-    #player {
-      display: none;
-    }
     #click_to_start {
       position: absolute;
       top: 0; left: 0; right: 0; bottom: 0;
@@ -123,7 +110,6 @@ HTML = '''
 <div id="left">
   <img id="expression" src="/static/animations/wakeup.svg" />
   <div id="status">🎤 等待開始錄音...</div>
-  <audio id="player" controls></audio>
 </div>
 
 <div id="right">
@@ -134,7 +120,6 @@ HTML = '''
   const socket = io();
   const expr = document.getElementById('expression');
   const status = document.getElementById('status');
-  const player = document.getElementById('player');
   const chatLog = document.getElementById('chat_log');
   const clickLayer = document.getElementById('click_to_start');
 
@@ -144,43 +129,82 @@ HTML = '''
     clickLayer.addEventListener('click', () => {
       socket.emit('start_listening');
       status.innerText = '🎤 錄音中...';
-      player.play().catch(e => console.log("🔕 初次播放失敗（正常）"));
+      speaker.resume();  // 瀏覽器要使用者點擊後才允許出聲
       clickLayer.style.display = 'none';
     });
   };
 
-  socket.on('expression', (path) => {
+  // 一般事件照常註冊；server 併在一起送的 update 依欄位順序分派給同一組 handler
+  const handlers = {};
+  function on(event, fn) {
+    handlers[event] = fn;
+    socket.on(event, fn);
+  }
+
+  socket.on('update', (update) => {
+    for (const [event, value] of Object.entries(update)) {
+      if (handlers[event]) handlers[event](value);
+    }
+  });
+
+  on('expression', (path) => {
     expr.src = path;
   });
 
-  socket.on('audio_url', (url) => {
-    console.log("🔔 收到新的音檔 URL，開始播放");
+  // Polly 的 16k PCM 一段一段送來，用 Web Audio 接續排程播放，不必等整個音檔
+  const speaker = new (window.AudioContext || window.webkitAudioContext)();
+  let playhead = 0;
+  let playing = [];
+
+  function stopSpeaking() {
+    playing.forEach((src) => src.stop());
+    playing = [];
+    playhead = 0;
+  }
+
+  socket.on('audio_chunk', (data) => {
+    const pcm = new Int16Array(data);
+    const buffer = speaker.createBuffer(1, pcm.length, 16000);
+    const channel = buffer.getChannelData(0);
+    for (let i = 0; i < pcm.length; i++) {
+      channel[i] = pcm[i] / 32768;
+    }
+
+    const src = speaker.createBufferSource();
+    src.buffer = buffer;
+    src.connect(speaker.destination);
+    playhead = Math.max(playhead, speaker.currentTime);
+    src.start(playhead);
+    playhead += buffer.duration;
+
     expr.src = '/static/animations/speaking.gif';
-    player.pause();
-    player.src = url;
-    player.load();
-    player.play()
-      .then(() => console.log("🔊 音訊播放成功！"))
-      .catch((err) => {
-        console.error("❌ 播放失敗：", err);
-        status.innerText = '⚠️ 無法播放音訊，請檢查瀏覽器設定';
-      });
-
-    player.onended = () => {
-      console.log("🔕 音訊播放完畢，自動切回 idle");
-      expr.src = '/static/animations/idle.gif';
+    playing.push(src);
+    src.onended = () => {
+      playing = playing.filter((s) => s !== src);
+      if (playing.length === 0) {
+        console.log("🔕 音訊播放完畢，自動切回 idle");
+        expr.src = '/static/animations/idle.gif';
+      }
     };
   });
 
-  socket.on('status', (msg) => {
+  on('status', (msg) => {
     status.innerText = msg;
   });
 
-  socket.on('user_query', (text) => {
+  on('user_query', (text) => {
+    // 新的一輪對話：停掉還沒播完的舊回覆
     latestUserQuery = text;
+    stopSpeaking();
+    // 上一輪被取消時收不到 text_response，這裡也要把串流中的回覆收掉，新的 text_delta 才不會接到舊泡泡後面
+    streamingEntry = null;
+    streamingText = '';
   });
 
-  socket.on('text_response', (text) => {
+  let streamingEntry = null;   // 正在串流中的回覆
+  let streamingText = '';
+
+  function appendChatEntry(text) {
     const entry = document.createElement('div');
     entry.className = 'chat_entry';
     entry.innerHTML = `
@@ -189,6 +213,27 @@ HTML = '''
     `;
     chatLog.appendChild(entry);
     chatLog.scrollTop = chatLog.scrollHeight;
+    return entry.querySelector('.bot_response');
+  }
+
+  socket.on('text_delta', (delta) => {
+    if (!streamingEntry) {
+      streamingText = '';
+      streamingEntry = appendChatEntry('');
+    }
+    streamingText += delta;
+    streamingEntry.innerHTML = `🤖 ${streamingText}`;
+    chatLog.scrollTop = chatLog.scrollHeight;
+  });
+
+  on('text_response', (text) => {
+    // 有串流中的回覆就直接補成完整內容，不再新增一筆
+    if (streamingEntry) {
+      streamingEntry.innerHTML = `🤖 ${text}`;
+      streamingEntry = null;
+      return;
+    }
+    appendChatEntry(text);
   });
 </script>
 
@@ -198,152 +243,22 @@ HTML = '''
 
 '''
 
-@app.route('/')
-def index():
-    return render_template_string(HTML)
+app.add_url_rule('/', 'index', make_index(HTML))
 
 @app.route('/history_result/<filename>')
 def get_audio(filename):
-    return send_from_directory('history_result', filename)
-
-# async def handle_text(text: str):
-#     try:
-#         logger.info(f"[handle_text] 收到完整文字：{text}")
-#         socketio.emit('status', f"📝 偵測到文字：{text}")
-#         socketio.emit('user_query', text)
-
-#         tc = TaskClassifier()
-#         task_type, _ = tc.classify_task(text)
-#         logger.info(f"[handle_text] 任務分類結果：{task_type}")
-
-#         socketio.emit('expression', '/static/animations/thinking.gif')
-
-#         audio_path = None
-#         generated_text = None
-
-#         ts = time.strftime('%Y%m%d_%H%M%S')
-
-#         if task_type == "聊天":
-#             chat_model = Chatbot(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-#             generated_text = chat_model.chat(text)
-#             audio_path = f"./history_result/output_chat_{ts}.mp3"
-#             PollyTTS().synthesize(generated_text, audio_path)
-
-#         elif task_type == "查詢":
-#             ws = WebSearcher(max_results=3, search_depth="advanced", use_top_only=True)
-#             model = ConversationalModel(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-#             pipeline = RAGPipeline(web_searcher=ws, model=model)
-#             generated_text = pipeline.answer(text)
-#             audio_path = f"./history_result/output_search_{ts}.mp3"
-#             PollyTTS().synthesize(generated_text, audio_path)
-
-#         elif task_type == "行動":
-#             ad = ActionDecomposer()
-#             generated_text = ad.decompose(text)
-#             audio_path = None
-
-#         if generated_text:
-#             socketio.emit('text_response', generated_text)
-
-#         if audio_path and Path(audio_path).exists():
-#             logger.info(f"[handle_text] 音檔生成完成：{audio_path}")
-#             audio_url = f"/history_result/{os.path.basename(audio_path)}"
-#             socketio.emit('expression', '/static/animations/speaking.gif')
-#             socketio.emit('audio_url', audio_url)
-
-#         socketio.emit('status', '✅ 已完成。')
-
-#     except Exception as e:
-#         logger.error(f"[handle_text] 發生錯誤：{e}")
-
-async def handle_text(text: str):
-    try:
-        logger.info(f"[handle_text] 收到完整文字：{text}")
-        socketio.emit('status', f"📝 偵測到文字：{text}")
-        socketio.emit('user_query', text)
-
-        tc = TaskClassifier()
-        task_type, _ = retry_sync(retries=3, delay=1)(tc.classify_task)(text)
-        logger.info(f"[handle_text] 任務分類結果：{task_type}")
-
-        socketio.emit('expression', '/static/animations/thinking.gif')
-
-        audio_path = None
-        generated_text = None
-
-        ts = time.strftime('%Y%m%d_%H%M%S')
-
-        if task_type == "聊天":
-            chat_model = Chatbot(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-            generated_text = retry_sync(retries=3, delay=1)(chat_model.chat)(text)
-            audio_path = f"./history_result/output_chat_{ts}.mp3"
-            retry_sync(retries=3, delay=1)(PollyTTS().synthesize)(generated_text, audio_path)
-
-        elif task_type == "查詢":
-            ws = WebSearcher(max_results=3, search_depth="advanced", use_top_only=True)
-            model = ConversationalModel(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-            pipeline = RAGPipeline(web_searcher=ws, model=model)
-            generated_text = retry_sync(retries=3, delay=1)(pipeline.answer)(text)  # ✅ 改這裡
-            audio_path = f"./history_result/output_search_{ts}.mp3"
-            retry_sync(retries=3, delay=1)(PollyTTS().synthesize)(generated_text, audio_path)
-
-        elif task_type == "行動":
-            ad = ActionDecomposer()
-            generated_text = retry_sync(retries=3, delay=1)(ad.decompose)(text)
-            audio_path = None
-
-        if generated_text:
-            socketio.emit('text_response', generated_text)
-
-        if audio_path and Path(audio_path).exists():
-            logger.info(f"[handle_text] 音檔生成完成：{audio_path}")
-            audio_url = f"/history_result/{os.path.basename(audio_path)}"
-            socketio.emit('expression', '/static/animations/speaking.gif')
-            socketio.emit('audio_url', audio_url)
-
-        socketio.emit('status', '✅ 已完成。')
-
-    except Exception as e:
-        logger.error(f"[handle_text] 發生錯誤：{e}")
-
-
+    return send_history_audio(filename)
 
 async def cancellable_socket_handle_text(text: str):
-    global current_task
-
-    with current_task_lock:
-        # 先取消舊的
-        if current_task and not current_task.done():
-            logger.info("[cancellable_socket_handle_text] 取消上一個任務...")
-            current_task.cancel()
-
-        # 再開新的
-        loop = asyncio.get_running_loop()
-        current_task = loop.create_task(handle_text(text))
-
-def run_transcriber():
-    logger.info("[run_transcriber] 啟動 LiveTranscriber！")
-    with app.app_context():
-        attempt = 0
-        max_attempts = 2
-        while attempt < max_attempts:
-            try:
-                transcriber = LiveTranscriber(region="us-west-2", callback=cancellable_socket_handle_text)
-                asyncio.run(transcriber.start())
-                break
-            except Exception as e:
-                attempt += 1
-                logger.error(f"[run_transcriber] LiveTranscriber 連線失敗（第 {attempt} 次），錯誤: {e}")
-                if attempt >= max_attempts:
-                    logger.error("[run_transcriber] 已達最大重試次數，放棄連線。")
-                else:
-                    logger.info("[run_transcriber] 等待 2 秒後重試...")
-                    time.sleep(1)
+    await cancellable_run_pipeline(text, socketio.emit)
 
 @socketio.on('start_listening')
 def handle_start():
-    threading.Thread(target=run_transcriber, daemon=True).start()
+    # 麥克風 + Transcribe 在子行程跑，辨識結果回到 core 的常駐 loop 處理
+    start_transcriber(cancellable_socket_handle_text, get_loop())
 
 if __name__ == '__main__':
-    os.makedirs('history_result', exist_ok=True)
-    socketio.run(app, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    submit(warm_up_services())
+    socketio.run(app, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True,
+                 request_handler=NoDelayRequestHandler)
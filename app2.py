@@ -1,23 +1,10 @@
 import os
-import threading
-import asyncio
-import time
 import logging
-import base64
-import tempfile
-import subprocess
-from pathlib import Path
-from flask import Flask, render_template_string, send_from_directory, url_for
+from flask import Flask, request
 from flask_socketio import SocketIO
-from tools.retry_utils import retry_sync
-from rag_chat.rag import RAGPipeline, WebSearcher, ConversationalModel
-from rag_chat.chat import Chatbot
-from tts.tts import PollyTTS
-from agent.action_decompose import ActionDecomposer
-from task_classification.task_classification import TaskClassifier
-from amazon_transcribe.client import TranscribeStreamingClient
-from amazon_transcribe.handlers import TranscriptResultStreamHandler
-from amazon_transcribe.model import TranscriptEvent
+from core.web import HISTORY_DIR, NoDelayRequestHandler, make_index, orjson_socketio, send_history_audio
+from core.pipeline import IDLE_EXPRESSION, THINKING_EXPRESSION, cancel_session, cancellable_run_pipeline, submit, warm_up_services
+from core.audio import end_live, feed_live, process_audio, start_live
 
 # --- 環境初始化 ---
 logging.basicConfig(level=logging.INFO)
@@ -25,27 +12,10 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__, static_folder="static")
 app.config['SERVER_NAME'] = 'localhost:5000'
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-current_task = None
-current_task_lock = threading.Lock()
-
-# --- 啟動時檢查 ffmpeg ---
-try:
-    subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-except Exception:
-    logger.error("❌ 找不到 ffmpeg，請安裝 ffmpeg。")
-    raise
-
-# --- Transcript Handler ---
-class MyTranscriptHandler(TranscriptResultStreamHandler):
-    async def handle_transcript_event(self, transcript_event: TranscriptEvent):
-        for result in transcript_event.transcript.results:
-            if not result.is_partial:
-                text = result.alternatives[0].transcript.strip()
-                if text:
-                    logger.info(f"[process_audio_file] 轉出文字：{text}")
-                    await cancellable_socket_handle_text(text)
+# 刻意用 threading：真正的工作都在 core 的 asyncio loop / process pool 上跑，handler 只負責丟任務、馬上返回；
+# eventlet / gevent 的 monkey-patch 會跟 asyncio thread、multiprocessing、boto3 連線池互相干擾
+# async_handlers=False：同一個連線的事件依序處理，pcm_start → pcm_chunk → pcm_end 丟進常駐 loop 的順序才不會亂（handler 只 submit，不會卡住）
+socketio = SocketIO(app, async_mode="threading", cors_allowed_origins="*", json=orjson_socketio, async_handlers=False)
 
 HTML = '''
 <!doctype html>
@@ -123,9 +93,6 @@ HTML = '''
       color: #0b0c10;
       margin-top: 12px;
     }
-    #player {
-      display: none;
-    }
     #click_to_start {
       position: absolute;
       top: 0; left: 0; right: 0; bottom: 0;
@@ -164,7 +131,6 @@ HTML = '''
   <img id="expression" src="/static/animations/wakeup.svg" />
   <div id="status">🎤 等待開始錄音...</div>
   <div id="volume_bar"><div id="volume_fill"></div></div>
-  <audio id="player" controls></audio>
 </div>
 
 <div id="right">
@@ -176,27 +142,29 @@ const socket = io();
 const expr = document.getElementById('expression');
 const status = document.getElementById('status');
 const volumeFill = document.getElementById('volume_fill');
-const player = document.getElementById('player');
 const chatLog = document.getElementById('chat_log');
 const clickLayer = document.getElementById('click_to_start');
 
 let latestUserQuery = null;
 let mediaRecorder;
+let pcmSender = null;                     // 有 AudioWorklet 時邊錄邊送 PCM，否則為 null
 let audioChunks = [];
 let audioContext;
 let analyser;
+let samples;                              // 時域取樣緩衝區，只配置一次
 let stream;
 let isRecording = false;
 let recordingStartTime = null;
 let silenceStart = null;
 let weakNoiseStart = null;
 let backgroundVolumes = [];
+let backgroundSum = 0;                    // backgroundVolumes 的總和，跟著陣列增減，不必每幀重算
 let hasRecordedOnce = false; 
 
 const baseThreshold = 0.08;             // 基本啟動門檻
 let dynamicThreshold = baseThreshold;    // 動態啟動門檻
 const silenceThreshold = 0.02;           // 判定無聲
-const silenceDelay = 2000;               // 錄音中無聲多久停止錄音（毫秒）
+const silenceDelay = 800;                // 錄音中無聲多久停止錄音（毫秒）；講完話停頓一下就送出
 const maxRecordingTime = 12000;           // 錄音最大時長（毫秒）
 const weakNoiseIgnoreTime = 3000;         // 小聲雜訊超過多久忽略（毫秒）
 
@@ -204,6 +172,7 @@ window.onload = () => {
   clickLayer.addEventListener('click', async () => {
     try {
       await prepareMicrophone();
+      speaker.resume();  // 瀏覽器要使用者點擊後才允許出聲
       clickLayer.style.display = 'none';
     } catch (err) {
       console.error('⚠️ 無法啟動錄音：', err);
@@ -221,7 +190,9 @@ async function prepareMicrophone() {
   const source = audioContext.createMediaStreamSource(stream);
   analyser = audioContext.createAnalyser();
   analyser.fftSize = 2048;
+  samples = new Float32Array(analyser.fftSize);
   source.connect(analyser);
+  pcmSender = await preparePcmSender(source);
 
   mediaRecorder.addEventListener('dataavailable', event => {
     audioChunks.push(event.data);
@@ -233,13 +204,9 @@ async function prepareMicrophone() {
       const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
       audioChunks = [];
 
-      const reader = new FileReader();
-      reader.onloadend = () => {
-        const base64Audio = reader.result.split(',')[1];
-        socket.emit('audio_blob', base64Audio);
-        status.innerText = '📨 上傳音訊中...';
-      };
-      reader.readAsDataURL(audioBlob);
+      // 直接送 binary frame，不用先轉成 base64（少 33% 流量，兩邊也不用編解碼）
+      socket.emit('audio_blob', await audioBlob.arrayBuffer());
+      status.innerText = '📨 上傳音訊中...';
     }
     setTimeout(startListening, 500);
   });
@@ -247,12 +214,111 @@ async function prepareMicrophone() {
   startListening();
 }
 
+// --- 邊錄邊送：AudioWorklet 在音訊執行緒把麥克風降到 16k Int16，每 100 ms 送一個 frame
+// 降取樣時把每個 step 寬的窗口平均成一個樣本（簡單的低通），8 kHz 以上的能量才不會折回語音頻段；
+// 不用 new AudioContext({sampleRate: 16000})，Firefox 不允許把不同取樣率的麥克風接進去
+// AudioWorklet 只在安全來源（https / localhost）可用，其他情況維持錄完整段再上傳
+const PCM_WORKLET = `
+class PcmSender extends AudioWorkletProcessor {
+  constructor() {
+    super();
+    this.active = false;
+    this.step = sampleRate / 16000;
+    this.pos = 0;
+    this.sum = 0;
+    this.count = 0;
+    this.frame = new Int16Array(1600);
+    this.length = 0;
+    this.port.onmessage = (event) => {
+      if (event.data === 'start') {
+        this.active = true;
+      } else {
+        // 停止時把剩下不滿 100 ms 的樣本也送出，再通知主執行緒可以結束串流
+        if (this.length) this.port.postMessage(this.frame.slice(0, this.length).buffer);
+        this.port.postMessage('end');
+        this.active = false;
+      }
+      this.length = 0;
+      this.pos = 0;
+      this.sum = 0;
+      this.count = 0;
+    };
+  }
+  process(inputs) {
+    const input = inputs[0][0];
+    if (this.active && input) {
+      for (let i = 0; i < input.length; i++) {
+        this.sum += input[i];
+        this.count++;
+        if (++this.pos < this.step) continue;
+        this.pos -= this.step;
+        const v = Math.max(-1, Math.min(1, this.sum / this.count));
+        this.sum = 0;
+        this.count = 0;
+        this.frame[this.length++] = v * 32767;
+        if (this.length === this.frame.length) {
+          this.port.postMessage(this.frame.slice().buffer);
+          this.length = 0;
+        }
+      }
+    }
+    return true;
+  }
+}
+registerProcessor('pcm-sender', PcmSender);
+`;
+
+async function preparePcmSender(source) {
+  if (!window.isSecureContext || !audioContext.audioWorklet) return null;
+  try {
+    const url = URL.createObjectURL(new Blob([PCM_WORKLET], { type: 'application/javascript' }));
+    await audioContext.audioWorklet.addModule(url);
+    const node = new AudioWorkletNode(audioContext, 'pcm-sender');
+    node.port.onmessage = (event) => {
+      if (event.data === 'end') {
+        socket.emit('pcm_end');
+      } else {
+        socket.emit('pcm_chunk', event.data);
+      }
+    };
+    // 接到靜音的輸出上，瀏覽器才會持續驅動 process()
+    const mute = audioContext.createGain();
+    mute.gain.value = 0;
+    source.connect(node).connect(mute).connect(audioContext.destination);
+    return node;
+  } catch (err) {
+    console.warn('⚠️ 無法啟用即時串流，改用整段上傳：', err);
+    return null;
+  }
+}
+
+function beginRecording() {
+  if (pcmSender) {
+    socket.emit('pcm_start');
+    pcmSender.port.postMessage('start');
+  } else {
+    mediaRecorder.start();
+  }
+}
+
+function endRecording() {
+  if (pcmSender) {
+    pcmSender.port.postMessage('stop');
+    hasRecordedOnce = true;
+    status.innerText = '📨 辨識中...';
+    setTimeout(startListening, 500);
+  } else {
+    mediaRecorder.stop();
+  }
+}
+
 function startListening() {
   isRecording = false;
   recordingStartTime = null;
   silenceStart = null;
   weakNoiseStart = null;
   backgroundVolumes = [];
+  backgroundSum = 0;
   audioChunks = [];
   status.innerText = '👂 正在靜音監聽中...';
   
@@ -267,15 +333,15 @@ function startListening() {
 }
 
 function monitorVolume() {
-  const dataArray = new Uint8Array(analyser.fftSize);
-  analyser.getByteTimeDomainData(dataArray);
+  // 直接拿 [-1, 1] 的浮點取樣，不用再做 (x - 128) / 128 換算
+  analyser.getFloatTimeDomainData(samples);
 
   let sum = 0;
-  for (let i = 0; i < dataArray.length; i++) {
-    const normalized = (dataArray[i] - 128) / 128;
-    sum += normalized * normalized;
+  for (let i = 0; i < samples.length; i++) {
+    const v = samples[i];
+    sum += v * v;
   }
-  const volume = Math.sqrt(sum / dataArray.length);
+  const volume = Math.sqrt(sum / samples.length);
 
   // 更新音量條
   const volumePercentage = Math.min(100, Math.floor(volume * 300));
@@ -286,9 +352,10 @@ function monitorVolume() {
   // --- 背景音量統計 (只在待機時做) ---
   if (!isRecording) {
     backgroundVolumes.push(volume);
-    if (backgroundVolumes.length > 100) backgroundVolumes.shift();
+    backgroundSum += volume;
+    if (backgroundVolumes.length > 100) backgroundSum -= backgroundVolumes.shift();
 
-    const avgBackground = backgroundVolumes.reduce((a, b) => a + b, 0) / backgroundVolumes.length;
+    const avgBackground = backgroundSum / backgroundVolumes.length;
     if (avgBackground > 0.05) {
       dynamicThreshold = Math.min(0.15, baseThreshold + (avgBackground - 0.05));
     } else {
@@ -304,6 +371,7 @@ function monitorVolume() {
         console.log('💤 小聲雜訊超過3秒，忽略');
         weakNoiseStart = null;
         backgroundVolumes = [];
+        backgroundSum = 0;
       }
     } else {
       weakNoiseStart = null;
@@ -314,7 +382,7 @@ function monitorVolume() {
   if (!isRecording) {
     if (volume > dynamicThreshold) {
       console.log('🎙️ 偵測到說話，開始錄音！');
-      mediaRecorder.start();
+      beginRecording();
       recordingStartTime = now;
       silenceStart = null;
       isRecording = true;
@@ -327,14 +395,14 @@ function monitorVolume() {
     } else {
       if (!silenceStart) silenceStart = now;
       if (now - silenceStart > silenceDelay) {
-        console.log('🛑 錄音中偵測到靜音超過2秒，停止錄音');
-        mediaRecorder.stop();
+        console.log('🛑 錄音中偵測到靜音超過 0.8 秒，停止錄音');
+        endRecording();
         return;
       }
     }
     if (now - recordingStartTime > maxRecordingTime) {
       console.log('⏰ 錄音超過12秒，強制停止');
-      mediaRecorder.stop();
+      endRecording();
       return;
     }
   }
@@ -343,35 +411,77 @@ function monitorVolume() {
 }
 
 // --- 處理 server 回傳訊息 ---
-socket.on('expression', (path) => {
+// 一般事件照常註冊；server 併在一起送的 update 依欄位順序分派給同一組 handler
+const handlers = {};
+function on(event, fn) {
+  handlers[event] = fn;
+  socket.on(event, fn);
+}
+
+socket.on('update', (update) => {
+  for (const [event, value] of Object.entries(update)) {
+    if (handlers[event]) handlers[event](value);
+  }
+});
+
+on('expression', (path) => {
   expr.src = path;
 });
 
-socket.on('audio_url', (url) => {
+// Polly 的 16k PCM 一段一段送來，用 Web Audio 接續排程播放，不必等整個音檔
+const speaker = new (window.AudioContext || window.webkitAudioContext)();
+let playhead = 0;
+let playing = [];
+
+function stopSpeaking() {
+  playing.forEach((src) => src.stop());
+  playing = [];
+  playhead = 0;
+}
+
+socket.on('audio_chunk', (data) => {
+  const pcm = new Int16Array(data);
+  const buffer = speaker.createBuffer(1, pcm.length, 16000);
+  const channel = buffer.getChannelData(0);
+  for (let i = 0; i < pcm.length; i++) {
+    channel[i] = pcm[i] / 32768;
+  }
+
+  const src = speaker.createBufferSource();
+  src.buffer = buffer;
+  src.connect(speaker.destination);
+  playhead = Math.max(playhead, speaker.currentTime);
+  src.start(playhead);
+  playhead += buffer.duration;
+
   expr.src = '/static/animations/speaking.gif';
-  player.pause();
-  player.src = url;
-  player.load();
-  player.play().catch(err => console.error("❌ 播放失敗", err));
-  player.onended = () => {
-    expr.src = '/static/animations/idle.gif';
-    if (player.src.includes("/history_result/")) {
-      const filename = player.src.split("/history_result/")[1];
-      socket.emit('delete_audio', filename);
+  playing.push(src);
+  src.onended = () => {
+    playing = playing.filter((s) => s !== src);
+    if (playing.length === 0) {
+      console.log("🔕 音訊播放完畢，自動切回 idle");
+      expr.src = '/static/animations/idle.gif';
     }
   };
-
 });
 
-socket.on('status', (msg) => {
+on('status', (msg) => {
   status.innerText = msg;
 });
 
-socket.on('user_query', (text) => {
+on('user_query', (text) => {
+  // 新的一輪對話：停掉還沒播完的舊回覆
   latestUserQuery = text;
+  stopSpeaking();
+  // 上一輪被取消時收不到 text_response，這裡也要把串流中的回覆收掉，新的 text_delta 才不會接到舊泡泡後面
+  streamingEntry = null;
+  streamingText = '';
 });
 
-socket.on('text_response', (text) => {
+let streamingEntry = null;   // 正在串流中的回覆
+let streamingText = '';
+
+function appendChatEntry(text) {
   const entry = document.createElement('div');
   entry.className = 'chat_entry';
   entry.innerHTML = `
@@ -380,6 +490,27 @@ socket.on('text_response', (text) => {
   `;
   chatLog.appendChild(entry);
   chatLog.scrollTop = chatLog.scrollHeight;
+  return entry.querySelector('.bot_response');
+}
+
+socket.on('text_delta', (delta) => {
+  if (!streamingEntry) {
+    streamingText = '';
+    streamingEntry = appendChatEntry('');
+  }
+  streamingText += delta;
+  streamingEntry.innerHTML = `🤖 ${streamingText}`;
+  chatLog.scrollTop = chatLog.scrollHeight;
+});
+
+on('text_response', (text) => {
+  // 有串流中的回覆就直接補成完整內容，不再新增一筆
+  if (streamingEntry) {
+    streamingEntry.innerHTML = `🤖 ${text}`;
+    streamingEntry = null;
+    return;
+  }
+  appendChatEntry(text);
 });
 </script>
 
@@ -389,148 +520,70 @@ socket.on('text_response', (text) => {
 </html>
 
 '''
-@socketio.on('delete_audio')
-def delete_audio(filename):
-    try:
-        path = os.path.join('history_result', filename)
-        if os.path.exists(path):
-            os.remove(path)
-            logger.info(f"[delete_audio] 已刪除檔案：{path}")
-    except Exception as e:
-        logger.error(f"[delete_audio] 刪除檔案失敗：{e}")
-        
-# --- 音訊處理 ---
-@socketio.on('audio_blob')
-def handle_audio_blob(base64_audio):
-    logger.info("[handle_audio_blob] 收到音訊 blob，準備轉文字...")
-    
-    # ⭐ 新增：收到音訊後馬上切換成 thinking.gif
-    socketio.emit('expression', '/static/animations/thinking.gif')
-
-    try:
-        audio_data = base64.b64decode(base64_audio)
-
-        with tempfile.NamedTemporaryFile(suffix=".webm", delete=False) as tmp_file:
-            tmp_file.write(audio_data)
-            tmp_file_path = tmp_file.name
+def session_emitter(sid):
+    """只送給發話的那個分頁：多人同時連線時不會互相看到、聽到別人的回覆"""
+    def emit(event, payload):
+        socketio.emit(event, payload, to=sid)
+    return emit
 
-        def run_in_thread():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(process_audio_file(tmp_file_path))
-            loop.close()
+def session_text_handler(sid, emit):
+    async def handle_text(text: str):
+        await cancellable_run_pipeline(text, emit, session=sid)
+    return handle_text
 
-        threading.Thread(target=run_in_thread).start()
-
-    except Exception as e:
-        logger.error(f"[handle_audio_blob] 音訊處理失敗：{e}")
-
-
-async def process_audio_file(file_path):
-    try:
-        pcm_path = file_path.replace('.webm', '.wav')
-        subprocess.run(f"ffmpeg -y -i {file_path} -ac 1 -ar 16000 -f wav {pcm_path}", shell=True, check=True)
-
-        with open(pcm_path, 'rb') as f:
-            pcm_data = f.read()
-
-        client = TranscribeStreamingClient(region="us-west-2")
-        stream = await client.start_stream_transcription(
-            language_code="zh-TW",
-            media_sample_rate_hz=16000,
-            media_encoding="pcm",
-        )
-
-        chunk_size = 6400  
-        for i in range(0, len(pcm_data), chunk_size):
-            chunk = pcm_data[i:i+chunk_size]
-            await stream.input_stream.send_audio_event(audio_chunk=chunk)
-            await asyncio.sleep(0.1)
-
-        await stream.input_stream.end_stream()
+# --- 音訊處理 ---
+# 錄到的只有雜音：不跑 pipeline，表情切回 idle；內容固定，只建一次
+SILENCE_UPDATE = {'expression': IDLE_EXPRESSION, 'status': '🔇 未偵測到有效聲音'}
 
-        handler = MyTranscriptHandler(stream.output_stream)
-        async for event in stream.output_stream:
-            await handler.handle_transcript_event(event)
+@socketio.on('audio_blob')
+def handle_audio_blob(audio_data):
+    # 每段錄音都會進來，只在 DEBUG 才記錄；用 % 格式讓沒開 DEBUG 時連字串都不用組
+    logger.debug("[handle_audio_blob] 收到音訊 blob（%d bytes），準備轉文字...", len(audio_data))
+    sid = request.sid
+    emit = session_emitter(sid)
 
-    except Exception as e:
-        logger.error(f"[process_audio_file] 音訊處理失敗：{e}")
+    # ⭐ 收到音訊後馬上切換成 thinking.gif
+    emit('expression', THINKING_EXPRESSION)
 
-# --- 任務處理 ---
-async def handle_text(text: str):
     try:
-        logger.info(f"[handle_text] 收到完整文字：{text}")
-        socketio.emit('status', f"📝 偵測到文字：{text}")
-        socketio.emit('user_query', text)
-
-        task_classifier = TaskClassifier()
-        task_type, _ = retry_sync(retries=3, delay=1)(task_classifier.classify_task)(text)
-        logger.info(f"[handle_text] 任務分類結果：{task_type}")
-
-        socketio.emit('expression', '/static/animations/thinking.gif')
-
-        audio_path = None
-        generated_text = None
-        ts = time.strftime('%Y%m%d_%H%M%S')
-
-        if task_type == "聊天":
-            chat_model = Chatbot(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-            generated_text = retry_sync(retries=3, delay=1)(chat_model.chat)(text)
-            audio_path = f"./history_result/output_chat_{ts}.mp3"
-            retry_sync(retries=3, delay=1)(PollyTTS().synthesize)(generated_text, audio_path)
-
-        elif task_type == "查詢":
-            web_searcher = WebSearcher(max_results=3, search_depth="advanced", use_top_only=True)
-            conversational_model = ConversationalModel(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-            pipeline = RAGPipeline(web_searcher=web_searcher, model=conversational_model)
-            generated_text = retry_sync(retries=3, delay=1)(pipeline.answer)(text)
-            audio_path = f"./history_result/output_search_{ts}.mp3"
-            retry_sync(retries=3, delay=1)(PollyTTS().synthesize)(generated_text, audio_path)
-
-        elif task_type == "行動":
-            action_decomposer = ActionDecomposer()
-            generated_text = retry_sync(retries=3, delay=1)(action_decomposer.decompose)(text)
-
-        if generated_text:
-            socketio.emit('text_response', generated_text)
-
-        if audio_path and Path(audio_path).exists():
-            logger.info(f"[handle_text] 音檔生成完成：{audio_path}")
-            # ⭐ 在這裡補上 app context
-            with app.app_context():
-                audio_url = url_for('get_audio', filename=os.path.basename(audio_path))
-            socketio.emit('expression', '/static/animations/speaking.gif')
-            socketio.emit('audio_url', audio_url)
-
-        socketio.emit('status', '✅ 已完成。')
-
-    except asyncio.CancelledError:
-        logger.info("[handle_text] 任務被取消")
-        raise
+        # 丟進常駐 loop，不必每段錄音都開新 thread 跟新 event loop；解碼也在那邊做
+        submit(process_audio(audio_data, session_text_handler(sid, emit), on_silence=lambda: emit('update', SILENCE_UPDATE)))
     except Exception as e:
-        logger.error(f"[handle_text] 發生錯誤：{e}")
-
-
-async def cancellable_socket_handle_text(text: str):
-    global current_task
-    with current_task_lock:
-        if current_task and not current_task.done():
-            logger.info("[cancellable_socket_handle_text] 取消上一個任務...")
-            current_task.cancel()
+        logger.error(f"[handle_audio_blob] 音訊處理失敗：{e}")
 
-        loop = asyncio.get_running_loop()
-        current_task = loop.create_task(handle_text(text))
+# --- 邊錄邊送：frame 收到就轉給該分頁的 Transcribe 串流，不必等整段錄完再上傳、解碼
+@socketio.on('pcm_start')
+def handle_pcm_start():
+    sid = request.sid
+    emit = session_emitter(sid)
+    # 整段都沒轉出文字時切回 idle，不會一直停在思考中
+    submit(start_live(sid, session_text_handler(sid, emit), on_silence=lambda: emit('update', SILENCE_UPDATE)))
+
+@socketio.on('pcm_chunk')
+def handle_pcm_chunk(chunk):
+    submit(feed_live(request.sid, chunk))
+
+@socketio.on('pcm_end')
+def handle_pcm_end():
+    session_emitter(request.sid)('expression', THINKING_EXPRESSION)
+    submit(end_live(request.sid))
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    # 分頁關掉就不用再替它生成、合成語音，也把還開著的辨識串流收掉
+    submit(end_live(request.sid))
+    submit(cancel_session(request.sid))
 
 # --- 路由 ---
-@app.route('/')
-def index():
-    return render_template_string(HTML)
+app.add_url_rule('/', 'index', make_index(HTML))
 
 @app.route('/history_result/<filename>')
 def get_audio(filename):
-    return send_from_directory('history_result', filename)
+    return send_history_audio(filename)
 
 # --- 主程式 ---
 if __name__ == '__main__':
-    os.makedirs('history_result', exist_ok=True)
-    socketio.run(app, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    submit(warm_up_services(decode_pool=True))
+    socketio.run(app, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True,
+                 request_handler=NoDelayRequestHandler)
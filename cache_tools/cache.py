@@ -1,6 +1,12 @@
 import time
 import numpy as np
-import json
+import orjson
+import hashlib
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
 from typing import List, Dict, Optional, Tuple
 import boto3
 import sys
@@ -8,6 +14,26 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from tools.s3_utils import upload_file_to_s3
 from tools.client_utils import get_bedrock_client,get_bedrock_runtime_client
+from tools.retry_utils import retry_transient
+
+
+# 這些回覆會隨 prompt 調整而改變，不寫進 cache，每次都重新判斷
+UNCACHEABLE_PREFIXES = ("目前不支援", "目前伺服器有問題")
+
+# Titan Embeddings v2 預設維度
+EMBEDDING_DIM = 1024
+
+_PUNCTUATION_CATEGORIES = ("P", "S", "Z")
+
+def normalize_query(text: str) -> str:
+    """NFKC、去標點與空白、英文轉小寫，讓「幫我開燈。」和「幫我開燈」對到同一個 key"""
+    text = unicodedata.normalize("NFKC", text)
+    return "".join(
+        c for c in text.lower() if unicodedata.category(c)[0] not in _PUNCTUATION_CATEGORIES
+    )
+
+def should_cache(response: str) -> bool:
+    return bool(response) and not response.startswith(UNCACHEABLE_PREFIXES)
 
 
 def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
@@ -38,19 +64,27 @@ class InMemorySemanticCache:
 
         self.model_id = "amazon.titan-embed-text-v2:0"
         self.bedrock = get_bedrock_runtime_client("bedrock-runtime")
+        # 同一句話不重算 embedding
+        self._embed_normalized = lru_cache(maxsize=4096)(self._embed)
 
     def get_embedding(self, text: str) -> np.ndarray:
+        return self._embed_normalized(normalize_query(text) or text)
+
+    @retry_transient()
+    def _embed(self, text: str) -> np.ndarray:
         body = {"inputText": text}
         response = self.bedrock.invoke_model(
             modelId=self.model_id,
-            body=json.dumps(body),
+            body=orjson.dumps(body),
             contentType="application/json",
             accept="application/json"
         )
-        result = json.loads(response["body"].read())
+        result = orjson.loads(response["body"].read())
         return np.array(result["embedding"])
 
     def add_to_cache(self, query: str, response: str, ttl: int = 3600):
+        if not should_cache(response):
+            return
         embedding = self.get_embedding(query)
         if len(self.cache) >= self.max_cache_size:
             self.cache.sort(key=lambda x: x.usage_count)
@@ -100,7 +134,151 @@ class InMemorySemanticCache:
     
     def clear(self):
         self.session_log.clear()
-    
+
+
+class RedisSemanticCache(InMemorySemanticCache):
+    """跨 process / 重啟都保留的語意快取：embedding 存 Redis，用 RediSearch KNN 找最相近的一筆"""
+
+    def __init__(self, redis_url: str, similarity_threshold: float = 0.92,
+                 index_name: str = "semantic_cache", key_prefix: str = "semcache:"):
+        super().__init__(similarity_threshold=similarity_threshold)
+        import redis  # 只有設定 REDIS_URL 時才需要
+        from redis.commands.search.field import TextField, VectorField
+        from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+        self.redis = redis.Redis.from_url(redis_url)
+        self.index_name = index_name
+        self.key_prefix = key_prefix
+
+        try:
+            self.redis.ft(index_name).info()
+        except redis.ResponseError:
+            self.redis.ft(index_name).create_index(
+                [
+                    TextField("query"),
+                    TextField("response"),
+                    VectorField("embedding", "FLAT", {
+                        "TYPE": "FLOAT32",
+                        "DIM": EMBEDDING_DIM,
+                        "DISTANCE_METRIC": "COSINE",
+                    }),
+                ],
+                definition=IndexDefinition(prefix=[key_prefix], index_type=IndexType.HASH),
+            )
+
+    def add_to_cache(self, query: str, response: str, ttl: int = 3600):
+        if not should_cache(response):
+            return
+        embedding = self.get_embedding(query).astype(np.float32)
+        key = self.key_prefix + hashlib.sha1(normalize_query(query).encode("utf-8")).hexdigest()
+        self.redis.hset(key, mapping={
+            "query": query,
+            "response": response,
+            "embedding": embedding.tobytes(),
+        })
+        self.redis.expire(key, ttl)
+
+    def query_cache(self, query: str, k: int = 1) -> Optional[str]:
+        from redis.commands.search.query import Query
+
+        embedding = self.get_embedding(query).astype(np.float32)
+        knn = (
+            Query(f"*=>[KNN {k} @embedding $vec AS score]")
+            .sort_by("score")
+            .return_fields("response", "score")
+            .dialect(2)
+        )
+        result = self.redis.ft(self.index_name).search(knn, query_params={"vec": embedding.tobytes()})
+        for doc in result.docs:
+            # COSINE 回傳的是距離（1 - 相似度）
+            if 1 - float(doc.score) >= self.similarity_threshold:
+                return doc.response
+        return None
+
+
+
+class IntentCache:
+    """任務分類結果的兩層快取，不用呼叫任何 embedding 模型：
+    第一層：正規化後完全相同的句子，直接回傳 (類型, 拆解結果)
+    第二層：字元 n-gram 雜湊向量的 cosine 距離夠近就沿用類型，拆解結果不沿用（「走到茶水間」跟「走到會議室」很像但步驟不同）
+    每筆都有 TTL，prompt 或模型調整後舊的分類結果不會一直留著
+    """
+    def __init__(self, max_exact: int = 512, max_approx: int = 128,
+                 distance_threshold: float = 0.15, dim: int = 256, ttl: float = 600):
+        self.max_exact = max_exact
+        self.max_approx = max_approx
+        self.distance_threshold = distance_threshold
+        self.dim = dim
+        self.ttl = ttl
+        self._exact: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+        self._approx: "OrderedDict[str, Tuple[np.ndarray, str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.approx_hits = 0
+        self.misses = 0
+
+    def _vectorize(self, text: str) -> np.ndarray:
+        """單字 + 雙字 n-gram 雜湊到固定維度，再做 L2 正規化"""
+        vec = np.zeros(self.dim, dtype=np.float32)
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        for gram in grams:
+            vec[zlib.crc32(gram.encode("utf-8")) % self.dim] += 1.0
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def get(self, text: str) -> Optional[Tuple[str, str]]:
+        key = normalize_query(text)
+        if not key:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            if key in self._exact:
+                task_type, steps, expires = self._exact[key]
+                if expires > now:
+                    self._exact.move_to_end(key)
+                    self.exact_hits += 1
+                    return task_type, steps
+                del self._exact[key]
+
+            # 順便清掉過期的，避免近似比對一直掃到舊資料
+            for k in [k for k, (_, _, expires) in self._approx.items() if expires <= now]:
+                del self._approx[k]
+
+            if self._approx:
+                q_vec = self._vectorize(key)
+                best_key, best_sim = None, -1.0
+                for k, (vec, _, _) in self._approx.items():
+                    sim = float(np.dot(q_vec, vec))
+                    if sim > best_sim:
+                        best_key, best_sim = k, sim
+                if 1.0 - best_sim <= self.distance_threshold:
+                    self._approx.move_to_end(best_key)
+                    self.approx_hits += 1
+                    return self._approx[best_key][1], ""
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, task_type: str, steps: str = ""):
+        key = normalize_query(text)
+        if not key or not task_type:
+            return
+        # 拒絕 / 錯誤訊息會隨 prompt 改變，只記類型
+        steps = steps if should_cache(steps) else ""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._exact[key] = (task_type, steps, expires)
+            self._exact.move_to_end(key)
+            if len(self._exact) > self.max_exact:
+                self._exact.popitem(last=False)
+
+            self._approx[key] = (self._vectorize(key), task_type, expires)
+            self._approx.move_to_end(key)
+            if len(self._approx) > self.max_approx:
+                self._approx.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"exact_hits": self.exact_hits, "approx_hits": self.approx_hits, "misses": self.misses}
 
 
 def dummy_generator(query: str) -> str:
@@ -0,0 +1,201 @@
+import io
+import os
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+import av
+import numpy as np
+
+from amazon_transcribe.client import TranscribeStreamingClient
+from amazon_transcribe.handlers import TranscriptResultStreamHandler
+from amazon_transcribe.model import TranscriptEvent
+
+logger = logging.getLogger(__name__)
+
+OnText = Callable[[str], Awaitable[None]]
+
+# --- 伺服器端第二道 VAD：瀏覽器的音量門檻擋不掉持續的風扇聲、敲桌子之類的雜音
+# 以 20 ms 為一幀，能量夠大且過零率不高（不像嘶嘶聲）才算有人聲；有聲幀不到一成就不送 Transcribe
+VAD_FRAME_SAMPLES = 320          # 16 kHz × 20 ms
+VAD_ENERGY_THRESHOLD = 0.02      # 跟前端 silenceThreshold 一樣的 RMS 門檻
+VAD_MAX_ZCR = 0.35               # 每個取樣的過零比例上限
+VAD_MIN_SPEECH_RATIO = 0.1
+
+# 解碼是純 CPU 工作，多個使用者同時上傳時丟給固定大小的 process pool，才能真的用到多核心
+DECODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+_decode_pool = None
+_decode_pool_lock = threading.Lock()
+
+def get_decode_pool() -> ProcessPoolExecutor:
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ProcessPoolExecutor(
+                max_workers=DECODE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _decode_pool
+
+def _warm_worker():
+    """什麼都不做：worker 收到這個函式時就會 import 本模組（連帶 av / numpy），呼叫只是為了讓它先建起來"""
+
+def warm_up_decode_pool():
+    """啟動時先把每個 worker 都 spawn 好，第一段錄音不用付直譯器啟動跟 import av / numpy 的時間"""
+    pool = get_decode_pool()
+    # 沒有閒置 worker 時每次 submit 都會多開一個，送滿 DECODE_WORKERS 個就全部建好了
+    for future in [pool.submit(_warm_worker) for _ in range(DECODE_WORKERS)]:
+        future.result()
+
+@lru_cache(maxsize=None)
+def get_transcribe_client() -> TranscribeStreamingClient:
+    """整個行程共用一個 Transcribe client，credential / endpoint 只解析一次"""
+    return TranscribeStreamingClient(region="us-west-2")
+
+# --- Transcript Handler ---
+class MyTranscriptHandler(TranscriptResultStreamHandler):
+    def __init__(self, output_stream, on_text: OnText):
+        super().__init__(output_stream)
+        self.on_text = on_text
+
+    async def handle_transcript_event(self, transcript_event: TranscriptEvent):
+        for result in transcript_event.transcript.results:
+            if not result.is_partial:
+                text = result.alternatives[0].transcript.strip()
+                if text:
+                    logger.info("[process_audio] 轉出文字：%s", text)
+                    await self.on_text(text)
+
+def decode_to_pcm(audio_data: bytes) -> bytes:
+    """瀏覽器送來的 webm 直接在記憶體裡解碼成 16k 單聲道 s16 PCM，不經過 ffmpeg 子行程跟暫存檔"""
+    pcm = bytearray()
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=16000)
+    with av.open(io.BytesIO(audio_data)) as container:
+        # 每個 worker 只用一條 thread 解碼，避免 pool 開滿時搶 CPU
+        container.streams.audio[0].thread_count = 1
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                pcm += bytes(out.planes[0])[:out.samples * 2]
+    # 把 resampler 裡剩下的樣本也吐出來
+    for out in resampler.resample(None):
+        pcm += bytes(out.planes[0])[:out.samples * 2]
+    return bytes(pcm)
+
+def speech_ratio(pcm: bytes) -> float:
+    """回傳 PCM 裡被判定為人聲的 20 ms 幀比例，整段用 numpy 一次算完"""
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    n_frames = len(samples) // VAD_FRAME_SAMPLES
+    if n_frames == 0:
+        return 0.0
+    frames = samples[:n_frames * VAD_FRAME_SAMPLES].reshape(n_frames, VAD_FRAME_SAMPLES).astype(np.float32) / 32768
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+    speech = (rms > VAD_ENERGY_THRESHOLD) & (zcr < VAD_MAX_ZCR)
+    return float(np.mean(speech))
+
+def decode_and_detect(audio_data: bytes) -> Tuple[bytes, float]:
+    """在 decode pool 裡一起做完解碼跟 VAD，PCM 不用為了算比例再傳回主行程一次"""
+    pcm = decode_to_pcm(audio_data)
+    return pcm, speech_ratio(pcm)
+
+async def process_audio(audio_data: bytes, on_text: OnText, on_silence: Optional[Callable[[], Any]] = None):
+    """webm bytes → PCM → Transcribe 串流轉文字，每句完整結果交給 on_text；沒有人聲就呼叫 on_silence"""
+    try:
+        # webm 解碼吃 CPU，丟到 process pool，Socket.IO handler 跟常駐 loop 都不會被卡住
+        loop = asyncio.get_running_loop()
+        pcm_data, ratio = await loop.run_in_executor(get_decode_pool(), decode_and_detect, audio_data)
+
+        # 先過 VAD 再開串流：純雜音連 Transcribe 串流都不開，不必為它付費。
+        # 代價是有人聲的錄音要等解碼完才開串流，握手時間不再跟解碼重疊
+        if ratio < VAD_MIN_SPEECH_RATIO:
+            logger.debug("[process_audio] 人聲幀比例 %.0f%%，當作雜音不送 Transcribe", ratio * 100)
+            if on_silence:
+                on_silence()
+            return
+
+        stream = await _open_stream()
+
+        # 錄音已經完整收到了，不必照實際時間慢慢送；一次送 1 秒（32000 bytes），邊送邊收結果
+        chunk_size = 32000
+
+        async def send():
+            for i in range(0, len(pcm_data), chunk_size):
+                await stream.input_stream.send_audio_event(audio_chunk=pcm_data[i:i+chunk_size])
+            await stream.input_stream.end_stream()
+
+        # 任一邊出錯 TaskGroup 會自動取消另一邊，不會留下還在等結果的 receive
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(send())
+            tg.create_task(_receive(stream, on_text))
+
+    except Exception as e:
+        errors = e.exceptions if isinstance(e, ExceptionGroup) else (e,)
+        logger.error(f"[process_audio] 音訊處理失敗：{'; '.join(map(str, errors))}")
+
+# --- 瀏覽器邊錄邊送：每個 session 一條 Transcribe 串流，PCM frame 收到就轉送，講完時辨識也差不多完成了
+# session -> (frame queue, 串流 task)；task 也存起來，跑到一半才不會被 GC 回收。只會在常駐 loop 裡讀寫（透過 submit 呼叫），不需要 lock
+_live_sessions = {}
+
+async def start_live(session, on_text: OnText, on_silence: Optional[Callable[[], Any]] = None):
+    """開始一段邊錄邊送的辨識；同一個 session 還有沒結束的就先收掉"""
+    await end_live(session)
+    queue = asyncio.Queue()
+    task = asyncio.create_task(_stream_live(queue, on_text, on_silence))
+    _live_sessions[session] = (queue, task)
+    # 串流結束就移除，只在它還是這個 session 目前那一條時才移除
+    task.add_done_callback(lambda t: _live_sessions.pop(session, None) if _live_sessions.get(session, (None, None))[1] is t else None)
+
+async def feed_live(session, chunk: bytes):
+    live = _live_sessions.get(session)
+    if live:
+        live[0].put_nowait(chunk)
+
+async def end_live(session):
+    live = _live_sessions.get(session)
+    if live:
+        # 先不移除，讓 task 收完最後的結果；done callback 會清掉
+        live[0].put_nowait(None)
+
+async def _stream_live(queue: asyncio.Queue, on_text: OnText, on_silence: Optional[Callable[[], Any]] = None):
+    # 整段都沒轉出文字就呼叫 on_silence，畫面才不會一直停在思考中
+    heard = False
+
+    async def handle_text(text: str):
+        nonlocal heard
+        heard = True
+        await on_text(text)
+
+    try:
+        stream = await _open_stream()
+
+        async def send():
+            while (chunk := await queue.get()) is not None:
+                await stream.input_stream.send_audio_event(audio_chunk=chunk)
+            await stream.input_stream.end_stream()
+
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(send())
+            tg.create_task(_receive(stream, handle_text))
+
+    except Exception as e:
+        errors = e.exceptions if isinstance(e, ExceptionGroup) else (e,)
+        logger.error(f"[stream_live] 即時辨識失敗：{'; '.join(map(str, errors))}")
+
+    if not heard and on_silence:
+        on_silence()
+
+async def _open_stream():
+    return await get_transcribe_client().start_stream_transcription(
+        language_code="zh-TW",
+        media_sample_rate_hz=16000,
+        media_encoding="pcm",
+    )
+
+async def _receive(stream, on_text: OnText):
+    handler = MyTranscriptHandler(stream.output_stream, on_text)
+    async for event in stream.output_stream:
+        await handler.handle_transcript_event(event)
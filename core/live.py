@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import multiprocessing
+import queue as queue_errors
+import threading
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+OnText = Callable[[str], Awaitable[None]]
+
+# spawn 出來的子行程不會繼承 Flask / boto3 / event loop 的 thread 狀態
+_ctx = multiprocessing.get_context("spawn")
+_process = None
+_process_lock = threading.Lock()
+
+# 等 queue 時每隔幾秒確認一次子行程還活著，死掉（沒機會放 None）也不會把 executor thread 永遠卡住
+QUEUE_POLL_SECONDS = 1.0
+
+def _transcriber_main(queue, region: str):
+    """子行程：只負責麥克風 + Transcribe，辨識出的整段文字丟回 queue"""
+    from live_transcriber.live_transcriber import LiveTranscriber
+
+    async def push(text: str):
+        queue.put(text)
+
+    logging.basicConfig(level=logging.INFO)
+    logger.info("[run_transcriber] 啟動 LiveTranscriber！")
+    attempt = 0
+    max_attempts = 2
+    while attempt < max_attempts:
+        try:
+            transcriber = LiveTranscriber(region=region, callback=push)
+            asyncio.run(transcriber.start())
+            break
+        except Exception as e:
+            attempt += 1
+            logger.error(f"[run_transcriber] LiveTranscriber 連線失敗（第 {attempt} 次），錯誤: {e}")
+            if attempt >= max_attempts:
+                logger.error("[run_transcriber] 已達最大重試次數，放棄連線。")
+            else:
+                logger.info("[run_transcriber] 等待 2 秒後重試...")
+                time.sleep(1)
+    queue.put(None)
+
+def _next_text(queue, process):
+    """阻塞等下一段文字；子行程正常結束會收到 None，異常死掉就記錄下來並同樣回傳 None"""
+    while True:
+        try:
+            return queue.get(timeout=QUEUE_POLL_SECONDS)
+        except queue_errors.Empty:
+            if not process.is_alive():
+                logger.error("[consume] LiveTranscriber 子行程異常結束（exitcode=%s），停止接收；重新 start_listening 即可重啟", process.exitcode)
+                return None
+
+async def _consume(queue, process, on_text: OnText):
+    """主行程：從 queue 收文字交給回覆流程，子行程結束就停"""
+    while (text := await asyncio.to_thread(_next_text, queue, process)) is not None:
+        await on_text(text)
+
+def start_transcriber(on_text: OnText, loop: asyncio.AbstractEventLoop, region: str = "us-west-2"):
+    """在獨立行程跑 LiveTranscriber，避免音訊處理跟 LLM 回應解析搶同一個 GIL；已在跑就不重複開"""
+    global _process
+    with _process_lock:
+        if _process and _process.is_alive():
+            logger.info("[start_transcriber] LiveTranscriber 已在執行中")
+            return
+
+        queue = _ctx.Queue()
+        _process = _ctx.Process(target=_transcriber_main, args=(queue, region), daemon=True)
+        _process.start()
+        asyncio.run_coroutine_threadsafe(_consume(queue, _process, on_text), loop)
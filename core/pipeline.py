@@ -0,0 +1,258 @@
+import os
+import re
+import sys
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+logger = logging.getLogger(__name__)
+
+# emit(event, payload)：Flask 端直接傳 socketio.emit
+Emit = Callable[[str, Any], Any]
+
+# --- 共用的模型 / 服務實例：第一次用到才 import + 建立，之後所有 app 共用同一個
+# （spawn 出來的子行程會重新 import app，延後載入可以省下它們用不到的 rag / tts / agent 模組）
+@lru_cache(maxsize=None)
+def get_chat_model():
+    from rag_chat.chat import Chatbot
+    return Chatbot(model_id="anthropic.claude-3-haiku-20240307-v1:0")
+
+@lru_cache(maxsize=None)
+def get_rag_pipeline():
+    from rag_chat.rag import RAGPipeline, WebSearcher, ConversationalModel
+    web_searcher = WebSearcher(max_results=3, search_depth="advanced", use_top_only=True)
+    conversational_model = ConversationalModel(model_id="anthropic.claude-3-haiku-20240307-v1:0")
+    return RAGPipeline(web_searcher=web_searcher, model=conversational_model)
+
+@lru_cache(maxsize=None)
+def get_polly_tts():
+    from tts.tts import PollyTTS
+    return PollyTTS()
+
+@lru_cache(maxsize=None)
+def get_action_decomposer():
+    from agent.action_decompose import ActionDecomposer
+    return ActionDecomposer()
+
+# --- 可取消的處理任務狀態：每個 session（瀏覽器分頁的 sid；server 麥克風只有 None 一個）各自一個
+# 只會在常駐 loop 裡讀寫，不需要 lock
+current_tasks = {}
+
+# --- 常駐 event loop：瀏覽器每段錄音都丟到同一個 loop，新任務才取消得到舊任務
+_loop = None
+_loop_lock = threading.Lock()
+
+# to_thread / run_in_executor 幾乎都是在等 Bedrock / Polly 回應，worker 數對齊 boto3 連線池大小（CLIENT_CONFIG.max_pool_connections），
+# 不用預設的 min(32, cpu + 4)，多人同時講話時才不會排隊等 thread
+AWS_IO_WORKERS = 50
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=AWS_IO_WORKERS, thread_name_prefix="aws-io"))
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+def submit(coro):
+    """從 Socket.IO handler（一般 thread）把 coroutine 丟進常駐 loop"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+# 中文句尾：每湊滿一句就先丟給 Polly，不必等整段文字生成完
+SENTENCE_END = re.compile('[。！？\n]')
+
+# 前端表情圖；server 端送的表情都從這裡拿，改圖只要改一個地方
+THINKING_EXPRESSION = '/static/animations/thinking.gif'
+IDLE_EXPRESSION = '/static/animations/idle.gif'
+
+# 每次都一字不差會念到的固定台詞（RAG 查不到資料時的回覆），啟動時先合成好
+CANNED_PHRASES = ("根據目前的資料無法回答此問題。",)
+
+async def iterate_in_thread(gen_func, *args):
+    """把同步 generator 丟到 thread 跑，產出的片段透過 asyncio.Queue 一段一段送回 event loop"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+    # 任務被取消時通知 thread 停下來，並關掉 generator（連帶關掉底下的 Bedrock / Polly 串流）
+    stop = threading.Event()
+
+    def worker():
+        gen = gen_func(*args)
+        try:
+            for item in gen:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            gen.close()
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    future = loop.run_in_executor(None, worker)
+    try:
+        while (item := await queue.get()) is not done:
+            yield item
+        await future
+    finally:
+        stop.set()
+
+async def speak_sentences(deltas, emit: Emit) -> str:
+    """邊收文字邊切句子合成語音，PCM 一讀到就用 audio_chunk 依序推給前端播放，回傳完整文字"""
+    ready = asyncio.Queue()
+    pending = []
+    pieces = []
+    buffer = ""
+
+    async def emit_in_order():
+        while (task := await ready.get()) is not None:
+            # 前端收到 audio_chunk 就會自己切成 speaking，不用再多送一個 expression
+            if isinstance(task, bytes):
+                emit('audio_chunk', task)
+                continue
+            audio_stream = await task
+            async for chunk in iterate_in_thread(get_polly_tts().iter_pcm, audio_stream):
+                emit('audio_chunk', chunk)
+
+    def schedule(sentence: str):
+        # 固定台詞直接用預先合成好的 PCM
+        canned = get_polly_tts().canned.get(sentence)
+        if canned:
+            ready.put_nowait(canned)
+            return
+        # 每句一湊齊就先送出 Polly 請求，讀取則照順序來
+        task = asyncio.create_task(asyncio.to_thread(get_polly_tts().open_stream, sentence))
+        pending.append(task)
+        ready.put_nowait(task)
+
+    emitter = asyncio.create_task(emit_in_order())
+    try:
+        async for delta in deltas:
+            pieces.append(delta)
+            buffer += delta
+            while (match := SENTENCE_END.search(buffer)):
+                sentence, buffer = buffer[:match.end()].strip(), buffer[match.end():]
+                if sentence:
+                    schedule(sentence)
+        if buffer.strip():
+            schedule(buffer.strip())
+        ready.put_nowait(None)
+        await emitter
+    finally:
+        # 被新的一句話取消時，舊回覆的 Polly 請求跟音訊推送也要一起停，不然前端會繼續收到舊聲音
+        emitter.cancel()
+        for task in pending:
+            task.cancel()
+    return "".join(pieces).strip()
+
+async def emit_text_deltas(deltas, emit: Emit):
+    async for delta in deltas:
+        emit('text_delta', delta)
+        yield delta
+
+# --- 各任務類型的處理：回傳要顯示的完整文字，沒有就回傳 None
+async def _handle_chat(text: str, steps: str, emit: Emit):
+    # 串流生成文字、一句一句合成語音
+    deltas = emit_text_deltas(iterate_in_thread(get_chat_model().chat_stream, text), emit)
+    return await speak_sentences(deltas, emit)
+
+async def _handle_query(text: str, steps: str, emit: Emit):
+    # 搜尋完就串流生成摘要，跟聊天一樣一句一句合成語音
+    deltas = emit_text_deltas(iterate_in_thread(get_rag_pipeline().answer_stream, text), emit)
+    return await speak_sentences(deltas, emit)
+
+async def _handle_action(text: str, steps: str, emit: Emit):
+    if steps:
+        return steps
+    # 模型沒給拆解結果時才退回串流拆解；串流無法中途重試，錯誤已在 decompose_stream 內處理
+    deltas = emit_text_deltas(iterate_in_thread(get_action_decomposer().decompose_stream, text), emit)
+    return "".join([delta async for delta in deltas]).strip()
+
+async def _handle_other(text: str, steps: str, emit: Emit):
+    return None
+
+TASK_HANDLERS = {
+    "聊天": _handle_chat,
+    "查詢": _handle_query,
+    "行動": _handle_action,
+}
+
+async def run_pipeline(text: str, emit: Emit):
+    """分類 → 生成文字 → 合成語音，所有畫面更新都透過 emit 送出"""
+    try:
+        # 每句話都會經過的 log 用 % 參數，沒輸出時不必組字串
+        logger.info("[run_pipeline] 收到完整文字：%s", text)
+        # 同時發生的畫面更新併成一個 update 事件，少一次序列化跟一個 frame；分類期間就先顯示思考中
+        emit('update', {
+            'status': f"📝 偵測到文字：{text}",
+            'user_query': text,
+            'expression': THINKING_EXPRESSION,
+        })
+
+        # Polly 連線閒置太久才跟分類同時重新暖好，聊天 / 查詢一分完類就能直接合成第一句；
+        # 連線還熱著就不多打一次 describe_voices（行動根本用不到 Polly）
+        tts = get_polly_tts()
+        if tts.needs_warm_up():
+            warm_up = asyncio.create_task(asyncio.to_thread(tts.warm_up))
+            # 只是預熱，不等它也不讓它的錯誤影響這一輪；沒接住的例外記一筆就好
+            warm_up.add_done_callback(_log_warm_up_error)
+
+        # 分類與動作拆解合併成一次 Bedrock 呼叫，「行動」不用再多跑一輪（暫時性錯誤已在裡面重試，外面不用再包一層）
+        task_type, steps = await asyncio.to_thread(get_action_decomposer().classify_and_decompose, text)
+        logger.info("[run_pipeline] 任務分類結果：%s", task_type)
+
+        # 「其他」或分類失敗就不產生回覆，只把狀態更新成完成
+        handler = TASK_HANDLERS.get(task_type, _handle_other)
+        generated_text = await handler(text, steps, emit)
+
+        final = {'text_response': generated_text} if generated_text else {}
+        final['status'] = '✅ 已完成。'
+        emit('update', final)
+
+    except asyncio.CancelledError:
+        logger.info("[run_pipeline] 任務被取消")
+        raise
+    except Exception as e:
+        logger.error(f"[run_pipeline] 發生錯誤：{e}")
+
+def _log_warm_up_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.warning("[run_pipeline] Polly 預熱失敗：%s", task.exception())
+
+def _load_services():
+    for factory in (get_chat_model, get_rag_pipeline, get_polly_tts, get_action_decomposer):
+        factory()
+
+async def warm_up_services(decode_pool: bool = False):
+    """啟動後在背景載入各服務、打便宜的 API，讓第一個使用者不用付 import、credential 解析跟 TLS 握手的時間；
+    decode_pool=True（會收瀏覽器錄音的 app）時一併把解碼 process pool 的 worker 都開好"""
+    await asyncio.to_thread(_load_services)
+    warm_ups = [
+        asyncio.to_thread(get_polly_tts().prerender, CANNED_PHRASES),
+        asyncio.to_thread(get_action_decomposer().warm_up),
+    ]
+    if decode_pool:
+        from core.audio import warm_up_decode_pool
+        warm_ups.append(asyncio.to_thread(warm_up_decode_pool))
+    await asyncio.gather(*warm_ups)
+    logger.info("[warm_up_services] 服務已載入、Polly / Bedrock 連線已預熱、固定台詞已合成")
+
+async def cancellable_run_pipeline(text: str, emit: Emit, session=None):
+    """同一個 session 新的一句話進來就取消它還在跑的上一個任務，不影響其他使用者；必須在常駐 loop 上呼叫（submit 或 transcriber consumer）"""
+    await cancel_session(session)
+
+    task = asyncio.get_running_loop().create_task(run_pipeline(text, emit))
+    current_tasks[session] = task
+    # 跑完就移除，斷線的分頁不會一直留在 dict 裡
+    task.add_done_callback(lambda t: current_tasks.pop(session, None) if current_tasks.get(session) is t else None)
+
+async def cancel_session(session=None):
+    """取消某個 session 還在跑的任務（新的一句話進來、或瀏覽器斷線時）"""
+    task = current_tasks.get(session)
+    if task and not task.done():
+        logger.info("[cancellable_run_pipeline] 取消上一個任務...")
+        task.cancel()
@@ -0,0 +1,52 @@
+import os
+import re
+import gzip
+import hashlib
+import orjson
+from flask import Response, abort, request, send_from_directory
+from werkzeug.serving import WSGIRequestHandler
+
+def make_index(html: str):
+    """HTML 沒有任何 Jinja 變數，啟動時先編碼、壓縮好，每次請求直接回傳 bytes"""
+    body = html.encode("utf-8")
+    body_gz = gzip.compress(body, 9)
+    etag = hashlib.sha1(body).hexdigest()
+
+    def index():
+        if request.if_none_match.contains(etag):
+            return Response(status=304)
+
+        headers = {"Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+        if "gzip" in request.accept_encodings:
+            response = Response(body_gz, content_type="text/html; charset=utf-8", headers=headers)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(body, content_type="text/html; charset=utf-8", headers=headers)
+        response.set_etag(etag)
+        return response
+
+    return index
+
+# 語音檔目錄只解析一次；用專案根目錄的絕對路徑，跟從哪裡啟動 app 無關
+HISTORY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'history_result'))
+AUDIO_FILENAME = re.compile(r"^[\w\-.]+\.(?:wav|mp3)$")
+
+def send_history_audio(filename: str):
+    """檔名不像語音檔就直接 404，不碰檔案系統；conditional 讓瀏覽器可以用 ETag / Range 快取"""
+    if not AUDIO_FILENAME.match(filename):
+        abort(404)
+    return send_from_directory(HISTORY_DIR, filename, conditional=True)
+
+class orjson_socketio:
+    """給 SocketIO(json=...) 用的 orjson 包裝；python-socketio 會帶 separators 之類的參數，直接忽略即可"""
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+class NoDelayRequestHandler(WSGIRequestHandler):
+    """每條連線都設 TCP_NODELAY：WebSocket 升級後沿用同一個 socket，status / text_delta 這種小 frame 不會被 Nagle 卡住"""
+    disable_nagle_algorithm = True
@@ -50,7 +50,7 @@ class LiveTranscriber:
         return True
 
     async def mic_stream(self):
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         input_queue = asyncio.Queue()
 
         def callback(indata, frame_count, time_info, status):
@@ -95,7 +95,7 @@ class LiveTranscriber:
                 # ✅ 簡單噪音判斷
                 if not self.is_valid_text(text):
                     print(f"⚡ 濾掉無效文字：'{text}'")
-                    return  # 無效的就直接忽略，不加入 buffer
+                    continue  # 無效的就直接忽略，不加入 buffer
 
                 print(f"📝 偵測到新文字：{text}")
                 self.buffer.append(text)
@@ -133,7 +133,7 @@ class LiveTranscriber:
         self.buffer.clear()
 
         # 🔥 強制休息 2~3秒
-        wait_time = 3 + (asyncio.get_event_loop().time() % 1)  # 2.0~3.0秒之間
+        wait_time = 3 + (asyncio.get_running_loop().time() % 1)  # 2.0~3.0秒之間
         print(f"⏳ 等待 {wait_time:.2f} 秒避免過快連續送出...")
         await asyncio.sleep(wait_time)
 
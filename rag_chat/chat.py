@@ -2,18 +2,34 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from tools.cache_utils import get_cache
+from tools.bedrock_utils import (
+    converse_text,
+    iter_converse_stream_text,
+    iter_invoke_stream_text,
+    supports_latency_optimized,
+)
+from tools.client_utils import get_bedrock_runtime_client
+from tools.retry_utils import retry_transient
 from botocore.exceptions import ClientError
-import boto3
 import pandas as pd
-import json
+import orjson
+from typing import Iterator
 
 class Chatbot:
     def __init__(self, model_id: str):
         self.model_id = model_id
-        self.bedrock = boto3.client("bedrock-runtime")
+        self.bedrock = get_bedrock_runtime_client()
         self.cache = get_cache()
 
-    def generate_response(self, query: str) -> str:
+    def _converse_kwargs(self, query: str) -> dict:
+        return {
+            "modelId": self.model_id,
+            "messages": [{"role": "user", "content": [{"text": f"請以不超過 50 字的方式回答以下問題：{query}"}]}],
+            "inferenceConfig": {"maxTokens": 1024},
+            "performanceConfig": {"latency": "optimized"},
+        }
+
+    def _build_body(self, query: str) -> bytes:
         body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 1024,
@@ -27,17 +43,46 @@ class Chatbot:
     ]
 
         }
+        return orjson.dumps(body)
+
+    def _converse_optimized(self, query: str) -> str:
+        response = self.bedrock.converse(**self._converse_kwargs(query))
+        return converse_text(response)
+
+    @retry_transient()
+    def generate_response(self, query: str) -> str:
+        # 有支援的模型走 latency-optimized，其餘維持原本 invoke_model
+        if supports_latency_optimized(self.model_id):
+            return self._converse_optimized(query)
 
         response = self.bedrock.invoke_model(
             modelId=self.model_id,
-            body=json.dumps(body),
+            body=self._build_body(query),
             contentType="application/json",
             accept="application/json"
         )
         
-        result = json.loads(response["body"].read())
+        result = orjson.loads(response["body"].read())
         return result["content"][0]["text"]
 
+    def generate_stream(self, query: str) -> Iterator[str]:
+        yield from self._open_stream(query)
+
+    @retry_transient()
+    def _open_stream(self, query: str) -> Iterator[str]:
+        # 開始吐字之後就沒辦法重來，只重試建立串流這一步
+        if supports_latency_optimized(self.model_id):
+            response = self.bedrock.converse_stream(**self._converse_kwargs(query))
+            return iter_converse_stream_text(response)
+
+        response = self.bedrock.invoke_model_with_response_stream(
+            modelId=self.model_id,
+            body=self._build_body(query),
+            contentType="application/json",
+            accept="application/json"
+        )
+        return iter_invoke_stream_text(response)
+
     def chat(self, query: str) -> str:
         try:
             # 從 cache 拿，如果沒有就用 generate_response 並加進 cache
@@ -49,6 +94,27 @@ class Chatbot:
             print(f"API ERROR: {e}")
             return "目前伺服器有問題，請稍後再試。"
 
+    def chat_stream(self, query: str) -> Iterator[str]:
+        """串流版 chat：cache 命中就一次回傳，沒中就邊生成邊 yield"""
+        try:
+            cached = self.cache.query_cache(query)
+            if cached:
+                self.cache.session_log.append((query, cached))
+                yield cached
+                return
+
+            pieces = []
+            for delta in self.generate_stream(query):
+                pieces.append(delta)
+                yield delta
+
+            response = "".join(pieces)
+            self.cache.add_to_cache(query, response)
+            self.cache.session_log.append((query, response))
+        except ClientError as e:
+            print(f"API ERROR: {e}")
+            yield "目前伺服器有問題，請稍後再試。"
+
         
 if __name__ == "__main__":
 
@@ -1,7 +1,7 @@
 import os
-import json
+import orjson
 import time
-from typing import List, Dict
+from typing import List, Dict, Iterator
 from botocore.exceptions import ClientError
 import sys
 import boto3
@@ -9,6 +9,7 @@ from tavily import TavilyClient
 from dotenv import load_dotenv
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from tools.client_utils import get_bedrock_runtime_client
+from tools.bedrock_utils import iter_converse_stream_text
 from tools.cache_utils import get_cache
 
 class WebSearcher:
@@ -33,7 +34,7 @@ class WebSearcher:
             search_depth=self.search_depth
         )
         try:
-            result = json.loads(raw_result)
+            result = orjson.loads(raw_result)
 
             if self.use_top_only:
                 result = result[:1]  
@@ -121,6 +122,15 @@ class ConversationalModel:
         )
         return response['output']['message']
 
+    def converse_stream(self, messages: List[Dict]) -> Dict:
+        return self.client.converse_stream(
+            modelId=self.model_id,
+            messages=messages,
+            system=self.system_prompts,
+            inferenceConfig={"temperature": self.temperature},
+            additionalModelRequestFields={"top_k": self.top_k}
+        )
+
 class RAGPipeline:
     def __init__(self,
                  # retriever: Retriever,   # 目前因為沒有kb所以先不用
@@ -129,23 +139,24 @@ class RAGPipeline:
         # self.retriever = retriever  # 目前因為沒有kb所以先不用
         self.web_searcher = web_searcher
         self.model = model
-        self.messages: List[Dict] = []
         self.cache = get_cache()
 
-    def answer(self, query: str) -> str:
+    def _build_messages(self, query: str) -> List[Dict]:
         web_ctx = self.web_searcher.get_context(query)
         # vector_ctxs = self.retriever.retrieve(query)  # 目前因為沒有kb所以先不用
         # all_ctx = [web_ctx] + vector_ctxs  # 目前因為沒有kb所以先不用
         all_ctx = [web_ctx]  # 僅使用 web context
         prompt = PromptBuilder.build_prompt(all_ctx, query)
-        user_msg = {"role": "user", "content": [{"text": prompt}]}
-        self.messages.append(user_msg)
+        # 每題都自帶完整搜尋資料，不累積對話歷史：prompt 不會越跑越長，同一個 pipeline 也能給多個請求共用
+        return [{"role": "user", "content": [{"text": prompt}]}]
+
+    def answer(self, query: str) -> str:
+        messages = self._build_messages(query)
 
         max_retries, delay = 5, 1
         for attempt in range(max_retries):
             try:
-                resp = self.model.converse(self.messages)
-                self.messages.append(resp)
+                resp = self.model.converse(messages)
                 self.cache.add_to_cache(query, resp['content'][0]['text'])
                 return resp['content'][0]['text']
             except ClientError as e:
@@ -153,6 +164,27 @@ class RAGPipeline:
                     raise
                 time.sleep(delay * (2 ** attempt))
 
+    def answer_stream(self, query: str) -> Iterator[str]:
+        """串流版 answer：模型每吐出一段文字就 yield，結束後再寫回 cache"""
+        messages = self._build_messages(query)
+
+        # 串流開始後就沒辦法重來，所以只重試建立串流這一步
+        max_retries, delay = 5, 1
+        for attempt in range(max_retries):
+            try:
+                response = self.model.converse_stream(messages)
+                break
+            except ClientError as e:
+                if attempt == max_retries - 1:
+                    raise
+                time.sleep(delay * (2 ** attempt))
+
+        pieces = []
+        for delta in iter_converse_stream_text(response):
+            pieces.append(delta)
+            yield delta
+        self.cache.add_to_cache(query, "".join(pieces).strip())
+
 if __name__ == "__main__":
     web_searcher = WebSearcher(max_results=3, search_depth="advanced",use_top_only=True )
     # retriever = Retriever("YOUR_KB_ID", number_of_results=3)  
@@ -1,16 +1,13 @@
-import json
+import orjson
 from typing import Tuple
 import sys 
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from tools.client_utils import get_bedrock_runtime_client  # ✅ 用你的 function 取 client
+from tools.retry_utils import retry_transient
 
-class TaskClassifier:
-    def __init__(self, model_id: str = 'anthropic.claude-3-haiku-20240307-v1:0'):
-        self.model_id = model_id
-        self.accept = 'application/json'
-        self.content_type = 'application/json'
-        self.TASK_CLASSIFICATION_PROMPT = """
+# 也給 ActionDecomposer.classify_and_decompose 共用
+TASK_CLASSIFICATION_PROMPT = """
             請根據使用者輸入的內容，判斷該屬於哪一種類型的任務。
                 輸入：
                 你會收到一段使用者輸入的文字，這段文字會屬於以下三種任務類型之一。  
@@ -58,8 +55,23 @@ class TaskClassifier:
 
                 - 除了這兩個標籤包起來的內容之外，不要輸出其他文字。
             """
+
+class TaskClassifier:
+    def __init__(self, model_id: str = 'anthropic.claude-3-haiku-20240307-v1:0'):
+        self.model_id = model_id
+        self.accept = 'application/json'
+        self.content_type = 'application/json'
+        self.TASK_CLASSIFICATION_PROMPT = TASK_CLASSIFICATION_PROMPT
         self.system_prompt = self.TASK_CLASSIFICATION_PROMPT
         self.client = get_bedrock_runtime_client() 
+        # 除了使用者輸入以外 body 都是固定的，只序列化一次，呼叫時把佔位字串換掉
+        self._body_template = orjson.dumps({
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": 512,
+            "temperature": 0.0,
+            "system": self.system_prompt,
+            "messages": [{"role": "user", "content": "__TASK__"}],
+        })
 
     def _parse_tag(self, text: str, tag: str) -> str:
         start_tag = f"<{tag}>"
@@ -70,28 +82,19 @@ class TaskClassifier:
             return ""
         return text[start_index + len(start_tag):end_index].strip()
 
+    @retry_transient()
     def classify_task(self, task_description: str) -> Tuple[str, str]:
-        payload = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 512,
-            "temperature": 0.0,
-            "system": self.system_prompt,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [{"type": "text", "text": task_description}],
-                }
-            ]
-        }
+        content = orjson.dumps([{"type": "text", "text": task_description}])
+        body = self._body_template.replace(b'"__TASK__"', content, 1)
 
         response = self.client.invoke_model(
-            body=json.dumps(payload),
+            body=body,
             modelId=self.model_id,
             accept=self.accept,
             contentType=self.content_type
         )
 
-        model_response = json.loads(response["body"].read())
+        model_response = orjson.loads(response["body"].read())
         response_text = model_response["content"][0]["text"]
 
         task_class = self._parse_tag(response_text, "class")
@@ -0,0 +1,75 @@
+import orjson
+from typing import Any, Dict, Iterator, List
+
+# Bedrock 上支援 prompt caching 的 Claude 模型（haiku-3 帶 cache_control 會直接報錯）
+PROMPT_CACHING_MODELS = (
+    "claude-3-5-sonnet-20241022-v2",
+    "claude-3-5-haiku",
+    "claude-3-7-sonnet",
+    "claude-sonnet-4",
+    "claude-opus-4",
+)
+
+def supports_prompt_caching(model_id: str) -> bool:
+    return any(name in model_id for name in PROMPT_CACHING_MODELS)
+
+# 把多段 system prompt 轉成 content blocks，每段結尾各放一個 cache 檢查點
+def build_cached_system(sections: List[str], model_id: str) -> Any:
+    if not supports_prompt_caching(model_id):
+        return "\n".join(sections)
+
+    blocks: List[Dict] = []
+    for section in sections:
+        blocks.append({
+            "type": "text",
+            "text": section,
+            "cache_control": {"type": "ephemeral"},
+        })
+    return blocks
+
+# Converse API 版本：用 cachePoint 區塊標記快取位置
+def build_converse_system(sections: List[str], model_id: str) -> List[Dict]:
+    caching = supports_prompt_caching(model_id)
+    blocks: List[Dict] = []
+    for section in sections:
+        blocks.append({"text": section})
+        if caching:
+            blocks.append({"cachePoint": {"type": "default"}})
+    return blocks
+
+# 支援 latency-optimized inference 的模型（需走 Converse API 的 performanceConfig）
+LATENCY_OPTIMIZED_MODELS = (
+    "claude-3-5-haiku",
+)
+
+def supports_latency_optimized(model_id: str) -> bool:
+    return any(name in model_id for name in LATENCY_OPTIMIZED_MODELS)
+
+def converse_text(response: Dict) -> str:
+    content_blocks = response["output"]["message"]["content"]
+    return "\n".join(block.get("text", "") for block in content_blocks).strip()
+
+# 解析 invoke_model_with_response_stream 的事件，只取文字片段
+def iter_invoke_stream_text(response: Dict) -> Iterator[str]:
+    for event in response["body"]:
+        chunk = orjson.loads(event["chunk"]["bytes"])
+        if chunk.get("type") == "content_block_delta":
+            delta = chunk["delta"].get("text")
+            if delta:
+                yield delta
+
+# 解析 converse_stream 的事件，只取文字片段
+def iter_converse_stream_text(response: Dict) -> Iterator[str]:
+    for event in response["stream"]:
+        delta = event.get("contentBlockDelta", {}).get("delta", {}).get("text")
+        if delta:
+            yield delta
+
+# 解析 invoke_model_with_response_stream 的 tool_use 事件，只取參數 JSON 片段
+def iter_invoke_stream_tool_json(response: Dict) -> Iterator[str]:
+    for event in response["body"]:
+        chunk = orjson.loads(event["chunk"]["bytes"])
+        if chunk.get("type") == "content_block_delta":
+            partial = chunk["delta"].get("partial_json")
+            if partial:
+                yield partial
@@ -3,7 +3,17 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import cache_tools.cache as cache
 
-semi_cache = cache.InMemorySemanticCache()
+# 有設定 REDIS_URL 就用 Redis 的持久化語意快取，否則維持 in-memory
+if os.getenv("REDIS_URL"):
+    semi_cache = cache.RedisSemanticCache(os.environ["REDIS_URL"])
+else:
+    semi_cache = cache.InMemorySemanticCache()
 
 def get_cache():
-    return semi_cache
\ No newline at end of file
+    return semi_cache
+
+# 任務分類的快取不需要 embedding，一律 in-memory
+intent_cache = cache.IntentCache()
+
+def get_intent_cache():
+    return intent_cache
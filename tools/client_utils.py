@@ -1,19 +1,75 @@
 import os
-from typing import Any
+import logging
+from functools import lru_cache
+from typing import Any, Callable
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ConnectionClosedError, ReadTimeoutError
+from urllib3.exceptions import ProtocolError
+
+logger = logging.getLogger(__name__)
+
+# boto3 client 是 thread-safe 的，建一次就重複使用（省掉載入 service model、解析 credential 的時間）
+
+# 聊天、拆解、分類、Polly 會同時打 AWS，連線池開大一點、保持 keep-alive，避免排隊跟重新 TLS 握手
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=30,
+)
+
+# bedrock-runtime / Polly 的呼叫都已經在方法上掛了 retry_transient（含連線錯誤），botocore 就不要再重試一層，
+# 不然一次節流最多會變成 3×3 次請求，adaptive 的限速等待還會疊在 0.2 / 0.4 / 0.8 秒的退避上面
+APP_RETRIED_SERVICES = ("bedrock-runtime", "polly")
+NO_RETRY_CONFIG = CLIENT_CONFIG.merge(Config(retries={"max_attempts": 1, "mode": "standard"}))
+
+# 連線已經死掉時會丟的錯誤：遇到就整個 client 重建，不要讓重試一直撞同一個壞掉的連線池
+STALE_CONNECTION_ERRORS = (ConnectionClosedError, ReadTimeoutError, ProtocolError)
+
+class _SelfHealingClient:
+    """包一層 boto3 client，遇到死連線就重建 client 再試一次，呼叫端不用改"""
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._client = factory()
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                return getattr(self._client, name)(*args, **kwargs)
+            except STALE_CONNECTION_ERRORS as e:
+                logger.warning(f"[client_utils] 連線失效（{e}），重建 client 後重試")
+                self._client = self._factory()
+                return getattr(self._client, name)(*args, **kwargs)
+        return call
+
+def _build_client(service: str) -> Any:
+    config = NO_RETRY_CONFIG if service in APP_RETRIED_SERVICES else CLIENT_CONFIG
+    return _SelfHealingClient(
+        lambda: boto3.client(service, region_name=os.getenv('AWS_REGION', 'us-west-2'), config=config)
+    )
 
 # Create and return a Bedrock client
+@lru_cache(maxsize=None)
 def get_bedrock_client(service: str = 'bedrock') -> Any:
-    return boto3.client(service, region_name=os.getenv('AWS_REGION', 'us-west-2'))
+    return _build_client(service)
 
 # Create and return a Bedrock client
+@lru_cache(maxsize=None)
 def get_bedrock_runtime_client(service: str = 'bedrock-runtime') -> Any:
-    return boto3.client(service, region_name=os.getenv('AWS_REGION', 'us-west-2'))
+    return _build_client(service)
 
 # Create and return a Polly client
+@lru_cache(maxsize=None)
 def get_polly_client(service: str = 'polly') -> Any:
-    return boto3.client(service, region_name=os.getenv('AWS_REGION', 'us-west-2'))
+    return _build_client(service)
 
 # Create and return a S3 client
+@lru_cache(maxsize=None)
 def get_s3_client(service: str = 's3') -> Any:
-    return boto3.client(service, region_name=os.getenv('AWS_REGION', 'us-west-2'))
\ No newline at end of file
+    return _build_client(service)
@@ -0,0 +1,45 @@
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 只清語音檔；chat_log 之類的 .txt 要留著上傳 S3
+AUDIO_SUFFIXES = (".wav", ".mp3")
+
+def remove_old_audio(directory: str, max_age: float) -> int:
+    """掃一次資料夾，把超過 max_age 秒的語音檔一起刪掉，回傳刪掉幾個"""
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(AUDIO_SUFFIXES) and entry.is_file() and entry.stat().st_mtime < cutoff:
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except OSError as e:
+                        logger.warning("[audio_gc] 刪除 %s 失敗：%s", entry.path, e)
+    except FileNotFoundError:
+        pass
+    return removed
+
+_gc_started = set()
+_gc_lock = threading.Lock()
+
+def start_audio_gc(directory: str = "history_result", max_age: float = 600, interval: float = 60):
+    """背景 thread 定期清掉舊的語音檔，不用前端播完再回頭通知刪檔；同一個資料夾只會啟動一次"""
+    with _gc_lock:
+        if directory in _gc_started:
+            return
+        _gc_started.add(directory)
+
+    def loop():
+        while True:
+            removed = remove_old_audio(directory, max_age)
+            if removed:
+                logger.info("[audio_gc] 🧹 清掉 %d 個舊語音檔（%s）", removed, directory)
+            time.sleep(interval)
+
+    threading.Thread(target=loop, daemon=True).start()
@@ -1,42 +1,41 @@
 import asyncio
+import logging
 import sys
 import os
 import time
+import uuid
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from rag_chat.rag import RAGPipeline, WebSearcher, ConversationalModel
-from rag_chat.chat import Chatbot
-from tts.tts import PollyTTS
 from tools.cache_utils import get_cache
-from agent.action_decompose import ActionDecomposer
+from core.pipeline import get_chat_model, get_rag_pipeline, get_polly_tts, get_action_decomposer
 from task_classification.task_classification import TaskClassifier
 from live_transcriber.live_transcriber import LiveTranscriber
+from tools.file_utils import start_audio_gc
+
+# 跟 app 共用 core 裡建好的實例，每句話不用重建 boto3 client
+task_classifier = TaskClassifier()
+
+def new_audio_path(kind: str) -> str:
+    """時間戳只到秒，同一秒內的兩句話會撞名；後面再接一段隨機碼"""
+    return f"./history_result/output_{kind}_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.wav"
 
 def search_flow(query: str):
-    web_searcher = WebSearcher(max_results=3, search_depth="advanced", use_top_only=True)
-    model = ConversationalModel(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-
-    pipeline = RAGPipeline(web_searcher=web_searcher, model=model)
-    answer = pipeline.answer(query)
-    
-    tts_model = PollyTTS()
-    timestamp = time.strftime('%Y%m%d_%H%M%S')
-    tts_model.synthesize(answer, f"./history_result/output_search_{timestamp}.wav")
+    answer = get_rag_pipeline().answer(query)
+
+    audio_path = new_audio_path("search")
+    get_polly_tts().synthesize(answer, audio_path)
     print(f"🔎 搜尋結果：{answer}")
-    return f"./history_result/output_search_{timestamp}.wav"
+    return audio_path
 
 def chat_flow(query: str):
-    chat_model = Chatbot(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-    response = chat_model.chat(query)
+    response = get_chat_model().chat(query)
 
-    tts_model = PollyTTS()
-    timestamp = time.strftime('%Y%m%d_%H%M%S')
-    tts_model.synthesize(response, f"./history_result/output_chat_{timestamp}.wav")
+    audio_path = new_audio_path("chat")
+    get_polly_tts().synthesize(response, audio_path)
     print(f"💬 聊天回應：{response}")
-    return f"./history_result/output_chat_{timestamp}.wav"
+    return audio_path
 
 def task_flow(query: str) -> str:
-    task_classifier = TaskClassifier()
     task_type, task_description = task_classifier.classify_task(query)
     return task_type
 
@@ -67,13 +66,15 @@ def main_flow():
         print(f"⚠️ 發生錯誤：{e}")
 
 def action_flow(query):
-    decomposer = ActionDecomposer(model_id = "us.anthropic.claude-3-5-sonnet-20241022-v2:0")
-    response = decomposer.decompose(query)
+    response = get_action_decomposer().decompose(query)
     print(response)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     cache = get_cache()
     cache.clear()
+    # 每句回覆都會寫一個 wav，留最近十分鐘的就好
+    start_audio_gc('history_result')
 
     print("🚀 啟動語音助理系統！請開始說話...")
     main_flow()
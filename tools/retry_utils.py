@@ -2,6 +2,7 @@ import asyncio
 import functools
 import time
 import logging
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
 
 logger = logging.getLogger(__name__)
 
@@ -42,3 +43,35 @@ def retry_sync(retries=3, delay=1.0, backoff=2.0, exceptions=(Exception,)):
                     _delay *= backoff
         return wrapper
     return decorator
+
+# Bedrock / Polly 真的值得重試的錯誤；ValidationException / AccessDeniedException / TextLengthExceededException 這類重試也不會好，直接拋出
+TRANSIENT_ERROR_CODES = (
+    "ThrottlingException", "ModelTimeoutException", "ServiceUnavailableException",
+    "InternalServerException", "ServiceFailureException",
+)
+# botocore 對 bedrock-runtime / Polly 不再重試（見 client_utils.NO_RETRY_CONFIG），連不上、逾時也要在這裡接住
+TRANSIENT_CONNECTION_ERRORS = (EndpointConnectionError, ConnectTimeoutError, ConnectionClosedError, ReadTimeoutError)
+
+def retry_transient(retries=3, delay=0.2, backoff=2.0):
+    """只重試暫時性的 AWS 錯誤（節流、服務端暫時失敗、連線問題），間隔 0.2 → 0.4 → 0.8 秒"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _delay = delay
+            for attempt in range(retries + 1):
+                try:
+                    return func(*args, **kwargs)
+                except ClientError as e:
+                    code = e.response.get("Error", {}).get("Code", "")
+                    if code not in TRANSIENT_ERROR_CODES or attempt == retries:
+                        raise
+                    reason = code
+                except TRANSIENT_CONNECTION_ERRORS as e:
+                    if attempt == retries:
+                        raise
+                    reason = type(e).__name__
+                logger.warning(f"[retry_transient] {reason}，{_delay:.1f} 秒後重試...")
+                time.sleep(_delay)
+                _delay *= backoff
+        return wrapper
+    return decorator
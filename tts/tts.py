@@ -1,11 +1,15 @@
 import boto3
 import sys
 import os
-import io
-# from pydub import AudioSegment
+import struct
+import time
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from tools.client_utils import get_polly_client
+from tools.retry_utils import retry_transient
+
+# 連線閒置超過這個秒數才需要重新預熱；比 AWS 端 keep-alive 的逾時短一點
+IDLE_WARM_UP_SECONDS = 50
 
 class PollyTTS:
     def __init__(self):
@@ -17,29 +21,87 @@ class PollyTTS:
             "OutputFormat": "mp3",     # Polly 只能生 mp3, ogg_vorbis, pcm
             "SampleRate": "16000",
         }
+        # 固定台詞預先合成好的 PCM，之後念到同一句就不用再打 Polly
+        self.canned = {}
+        # 最後一次打 Polly 的時間（monotonic），用來判斷連線池是不是閒置太久
+        self.last_used = 0.0
 
-    def synthesize(self, text, output_filename):
-        params = {**self.defaults, "Text": text}
-        response = self.client.synthesize_speech(**params)
-        audio_stream = response["AudioStream"].read()
+    def needs_warm_up(self) -> bool:
+        """連線閒置太久就回傳 True，並先記下時間，接著進來的句子不會再各打一次"""
+        now = time.monotonic()
+        if now - self.last_used <= IDLE_WARM_UP_SECONDS:
+            return False
+        self.last_used = now
+        return True
+
+    def warm_up(self):
+        """先打一個便宜的 API 把連線建好，之後 synthesize 就不用再做 TLS 握手"""
+        self.last_used = time.monotonic()
+        try:
+            self.client.describe_voices(LanguageCode=self.defaults["LanguageCode"])
+        except Exception as e:
+            print(f"Polly warm up failed: {e}")
+
+    def prerender(self, phrases):
+        """把固定台詞先合成成 PCM 放在記憶體，失敗的就照常走 Polly"""
+        for text in phrases:
+            try:
+                params = {**self.defaults, "Text": text, "OutputFormat": "pcm"}
+                self.canned[text] = self.client.synthesize_speech(**params)["AudioStream"].read()
+                self.last_used = time.monotonic()
+            except Exception as e:
+                print(f"Polly prerender failed: {text} {e}")
 
-        if output_filename.endswith(".mp3"):
-            # 直接存 mp3
-            with open(output_filename, "wb") as file:
-                file.write(audio_stream)
-            print(f"{output_filename} saved as MP3 successfully.")
+    @retry_transient()
+    def open_stream(self, text):
+        """跟 Polly 要 16k s16 PCM，只送出請求、回傳還沒讀的 AudioStream"""
+        params = {**self.defaults, "Text": text, "OutputFormat": "pcm"}
+        self.last_used = time.monotonic()
+        return self.client.synthesize_speech(**params)["AudioStream"]
 
-        # elif output_filename.endswith(".wav"):
-        #     # 轉成 wav 再存
-        #     audio = AudioSegment.from_file(io.BytesIO(audio_stream), format="mp3")
-        #     audio.export(output_filename, format="wav")
-        #     print(f"{output_filename} saved as WAV successfully.")
+    @staticmethod
+    def iter_pcm(audio_stream, chunk_size=8192):
+        """一段一段讀 PCM；每段都切成偶數長度，前端才不會把 16-bit 樣本切一半"""
+        leftover = b""
+        for chunk in audio_stream.iter_chunks(chunk_size=chunk_size):
+            chunk = leftover + chunk
+            cut = len(chunk) - len(chunk) % 2
+            leftover = chunk[cut:]
+            if cut:
+                yield chunk[:cut]
+
+    @staticmethod
+    def _wav_header(data_size: int, sample_rate: int, channels: int = 1, bits: int = 16) -> bytes:
+        """Polly 的 pcm 是 16-bit 單聲道 little-endian，補上 44 bytes 的 RIFF header 就是 wav"""
+        byte_rate = sample_rate * channels * bits // 8
+        block_align = channels * bits // 8
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", 36 + data_size, b"WAVE",
+            b"fmt ", 16, 1, channels, sample_rate, byte_rate, block_align, bits,
+            b"data", data_size,
+        )
+
+    @retry_transient()
+    def synthesize(self, text, output_filename, format=None):
+        # 沒指定 format 就看副檔名；wav 直接跟 Polly 要 pcm，不用再經過 pydub / ffmpeg 轉檔
+        format = format or ("pcm" if output_filename.endswith(".wav") else "mp3")
+        if format not in ("mp3", "pcm"):
+            raise ValueError("format must be 'mp3' or 'pcm'")
+
+        params = {**self.defaults, "Text": text, "OutputFormat": format}
+        self.last_used = time.monotonic()
+        response = self.client.synthesize_speech(**params)
+        audio_stream = response["AudioStream"].read()
 
-        else:
-            raise ValueError("Output filename must end with .mp3 or .wav")
+        with open(output_filename, "wb") as file:
+            if format == "pcm":
+                file.write(self._wav_header(len(audio_stream), int(params["SampleRate"])))
+            file.write(audio_stream)
+        print(f"{output_filename} saved as {'WAV' if format == 'pcm' else 'MP3'} successfully.")
 
 # --- example ---
 if __name__ == "__main__":
     polly = PollyTTS()
-    # polly.synthesize("哈囉，我們是我要進外商", "./history_result/output.wav")   # 存成 wav
+    polly.synthesize("哈囉，我們是我要進外商", "./history_result/output.wav")   # 存成 wav
     polly.synthesize("哈囉，我們是我要進外商", "./history_result/output.mp3")   # 存成 mp3